@@ -5,7 +5,19 @@ from pathlib import Path
 from textwrap import dedent
 
 
-def build_args(desktop):
+def positive_int(value):
+    """argparse type for counts that must be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid int value: {!r}'.format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return number
+
+
+def build_args(desktop, argv=None):
     """method for defining and parsing commandline options"""
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -38,15 +50,46 @@ def build_args(desktop):
     parser.add_argument('-c', '--config',
                         help='edit the configuration file, set initially to the user\'s \
         default text editor', action='store_true')
-    parser.add_argument('-a', '--filter', help='filter images by one of these aspect ratios: sd480, hd1050, hd1080, \
-        dci4k, hd1050x2, hd1080x2, dci4kx2, and auto. Note that the notation \
+    parser.add_argument('-a', '--filter', help='filter images by one or more comma-separated aspect ratios: sd480, \
+        hd1050, hd1080, dci4k, hd1050x2, hd1080x2, dci4kx2, auto, or W:H, e.g. \
+        "%(prog)s -a hd1080,dci4k". Note that the notation \
         is designed for easy identification by popular sample resolution, but \
         multiple resolutions may be filtered per aspect ratio (such as 4k UHD \
         and 1080 HD, since both are 16:9 aspect ratio).', nargs=1, metavar=(
         'ASPECT_RATIO'))
+    parser.add_argument('--tolerance',
+                        help='relative aspect ratio tolerance, e.g. 0.01 for 1%%',
+                        type=float, metavar='TOLERANCE')
+    parser.add_argument('--min-width',
+                        help='ignore images narrower than WIDTH pixels',
+                        type=int, metavar='WIDTH')
+    parser.add_argument('--min-height',
+                        help='ignore images shorter than HEIGHT pixels',
+                        type=int, metavar='HEIGHT')
+    parser.add_argument('--render',
+                        help='apply a copy of the image scaled to the screen, \
+        cached for repeat shows', action='store_true')
+    parser.add_argument('--per-monitor',
+                        help='apply a different image to each monitor, matched to \
+        its aspect ratio', action='store_true')
+    parser.add_argument('-m', '--monitor',
+                        help='match the auto filter to the monitor named MONITOR, e.g. \
+        "%(prog)s -a auto -m HDMI-1"; the primary monitor is used by default',
+                        nargs=1, metavar='MONITOR')
+    parser.add_argument('--selection',
+                        help='how random images are picked: random, weighted \
+        toward images not shown for the longest time, or shuffle to show every \
+        image once before repeating any', choices=[
+                            'random', 'weighted', 'shuffle'])
     parser.add_argument('-t', '--present',
                         help='ignore images in subdirectories',
                         action='store_true')
+    parser.add_argument('-j', '--jobs',
+                        help='number of threads used to scan directories and read images',
+                        type=positive_int, metavar='JOBS')
+    parser.add_argument('--rescan',
+                        help='rebuild the image index for the selected directory',
+                        action='store_true')
     parser.add_argument('-d', '--directory',
                         help='random background from DIRECTORY, e.g. "%(prog)s -d ~/Pictures"',
                         nargs=1)
@@ -83,10 +126,14 @@ def build_args(desktop):
     parser.add_argument('-l', '--list',
                         help='Use a file of newline-separated image paths, instead of a directory',
                         nargs=1, metavar='FILE')
+    parser.add_argument('-x', '--export',
+                        help='write the current images list to FILE as newline-separated paths, for use with -l',
+                        nargs=1, metavar='FILE')
     parser.add_argument('-s', '--slideshow', help="""create a background slideshow by looping the background in
         DIRECTORY directory or list, every DELAY seconds, COUNT number of times,
-        e.g. "%(prog)s -s ~/Pictures 5 10 random". DELAY must be greater than 0.\
-        COUNT of 0 sets COUNT to number of images in given directory. SWITCH
+        e.g. "%(prog)s -s ~/Pictures 5 10 random". DELAY must be greater than 0,\
+        and may be fractional or carry a unit (0.5, 90s, 10m, 1.5h), or be a\
+        quoted crontab schedule such as "*/15 * * * *" or @hourly. COUNT of 0 sets COUNT to number of images in given directory. SWITCH
         is either "random" or "alpha", and describes the order of the loop.
         DIRECTORY can also be 1 through 5, or directory1 through directory5.
         These are mapped to your preset directories in rwal.conf.""",
@@ -98,5 +145,24 @@ def build_args(desktop):
     parser.add_argument('-e', '--editbackground',
                         help='edit the current background, defaulted to the GIMP',
                         action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--dedupe',
+                        help='treat near-duplicate images, such as resized copies and re-encodes, \
+        as one, keeping the largest; requires Pillow, and NumPy speeds it up',
+                        action='store_true')
+    parser.add_argument('--daemon',
+                        help='keep running in the background, serving rwal \
+        commands from later invocations so they apply almost instantly',
+                        action='store_true')
+    parser.add_argument('--profile-startup',
+                        help='report time spent on imports, initialization, and the command',
+                        action='store_true')
+    parser.add_argument('--stats',
+                        help='report the time spent in each stage and counts of files stat\'ed, \
+        images opened, bytes read, subprocesses, and config reads and writes, \
+        as text (the default) or as JSON',
+                        nargs='?', const='human', choices=('human', 'json'))
+    parser.add_argument('--stats-log',
+                        help='append the stats report to FILE as a line of JSON; overrides \
+        Stats Log in rwal.conf', metavar='FILE')
+    args = parser.parse_args(argv)
     return args
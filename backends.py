@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Module of wallpaper backends, which apply an image without a shell; where a
+service can be reached directly, over D-Bus, a long-running rwal keeps the
+connection open between changes"""
+import os
+import re
+import glob
+import errno
+import subprocess
+from importlib.util import find_spec
+import instrument
+
+# xfdesktop properties holding each monitor's image
+XFCE_IMAGE = re.compile(r'screen.*/monitor.*(image-path|/last-image)$')
+XFCE_MONITOR = re.compile(r'/monitor([^/]+)/')
+
+
+def run_command(argv):
+    """run a program directly, with no shell between rwal and it"""
+    instrument.count('subprocess')
+    try:
+        with instrument.span(os.path.basename(argv[0])):
+            return subprocess.run(argv).returncode
+    except OSError as error:
+        print('rwal could not run {}: {}'.format(argv[0], error))
+        return None
+
+
+def mode_args(mode, template='{}'):
+    """the mode as an argument, or none if it isn't a mode name, so argv
+    only ever holds strings"""
+    return [template.format(mode)] if isinstance(mode, str) and mode else []
+
+
+def gi_available():
+    return find_spec('gi') is not None
+
+
+class Backend:
+    """applies one image to every monitor; backends able to show a different
+    image per monitor override apply_outputs()"""
+
+    def apply(self, picture, mode):
+        raise NotImplementedError
+
+    def apply_outputs(self, outputs, mode):
+        """apply a list of (screen, picture) pairs, primary monitor first"""
+        return self.apply(outputs[0][1], mode)
+
+
+class GSettingsBackend(Backend):
+    """GNOME3, Cinnamon, Unity and MATE; writes through Gio to dconf when
+    persistent, else runs gsettings directly"""
+
+    def __init__(self, schema, image_key, uri, persistent):
+        self.schema = schema
+        self.imageKey = image_key
+        self.uri = uri
+        self.settings = None
+        if persistent and gi_available():
+            import gi
+            gi.require_version('Gio', '2.0')
+            from gi.repository import Gio
+            self.Gio = Gio
+            self.settings = Gio.Settings.new(schema)
+
+    def apply(self, picture, mode):
+        value = 'file://{}'.format(picture) if self.uri else picture
+        keys = [self.imageKey]
+        if self.settings is not None:
+            # GNOME 42+ shows a separate image in dark style
+            if self.settings.props.settings_schema.has_key(
+                    self.imageKey + '-dark'):
+                keys.append(self.imageKey + '-dark')
+            if mode:
+                self.settings.set_string('picture-options', mode)
+            for key in keys:
+                self.settings.set_string(key, value)
+            self.Gio.Settings.sync()
+            return 0
+        if mode:
+            run_command(['gsettings', 'set', self.schema, 'picture-options',
+                         mode])
+        return run_command(['gsettings', 'set', self.schema, self.imageKey,
+                            value])
+
+    def apply_outputs(self, outputs, mode):
+        """one image spanning all monitors, composed from each one's image"""
+        from render import RenderCache
+        render = RenderCache()
+        if not render.modules['Pillow']:
+            return self.apply(outputs[0][1], mode)
+        try:
+            return self.apply(render.compose(outputs), 'spanned')
+        except (OSError, ValueError) as error:
+            print('rwal could not compose monitor images: {}'.format(error))
+            return self.apply(outputs[0][1], mode)
+
+
+class XfconfBackend(Backend):
+    """Xfce; sets every monitor's image property through xfconfd's D-Bus
+    interface when persistent, else with one xfconf-query per property"""
+    channel = 'xfce4-desktop'
+
+    def __init__(self, persistent):
+        self.proxy = None
+        if persistent and gi_available():
+            import gi
+            gi.require_version('Gio', '2.0')
+            from gi.repository import Gio, GLib
+            self.GLib = GLib
+            self.proxy = Gio.DBusProxy.new_for_bus_sync(
+                Gio.BusType.SESSION, Gio.DBusProxyFlags.NONE, None,
+                'org.xfce.Xfconf', '/org/xfce/Xfconf', 'org.xfce.Xfconf', None)
+
+    def call(self, method, signature, *args):
+        return self.proxy.call_sync(method,
+                                    self.GLib.Variant(signature, args),
+                                    0, -1, None).unpack()
+
+    def get_properties(self):
+        """map of each monitor's image property to its current value"""
+        if self.proxy is not None:
+            properties = self.call('GetAllProperties', '(ss)', self.channel,
+                                   '/backdrop')[0]
+        else:
+            instrument.count('subprocess')
+            listing = subprocess.run(
+                ['xfconf-query', '-c', self.channel, '-p', '/backdrop', '-l',
+                 '-v'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True).stdout
+            properties = dict(line.partition(' ')[::2]
+                              for line in listing.splitlines())
+        return {name: str(value).strip() for name, value in properties.items()
+                if XFCE_IMAGE.search(name)}
+
+    def set_property(self, name, value, kind='string'):
+        if self.proxy is not None:
+            variant = self.GLib.Variant('i' if kind == 'int' else 's', value)
+            return self.call('SetProperty', '(ssv)', self.channel, name,
+                             variant)
+        return run_command(['xfconf-query', '-c', self.channel, '-p', name,
+                            '-n', '-t', kind, '-s', str(value)])
+
+    def set_image(self, name, current, picture, mode):
+        if current == picture:
+            # xfdesktop only reloads an image when its path changes
+            self.set_property(name, '')
+        self.set_property(name, picture)
+        if mode and mode.isdigit():
+            style = name.rsplit('/', 1)[0] + '/image-style'
+            self.set_property(style, int(mode), 'int')
+
+    def apply(self, picture, mode):
+        for name, current in self.get_properties().items():
+            self.set_image(name, current, picture, mode)
+        return 0
+
+    def apply_outputs(self, outputs, mode):
+        """each monitor's properties get its own image, all set at once;
+        xfdesktop names monitors by connector, or by number before 4.14"""
+        pictures = dict((screen['name'], picture)
+                        for screen, picture in outputs)
+
+        def assign(item):
+            name, current = item
+            match = XFCE_MONITOR.search(name)
+            monitor = match.group(1) if match else ''
+            if monitor in pictures:
+                picture = pictures[monitor]
+            elif monitor.isdigit() and int(monitor) < len(outputs):
+                picture = outputs[int(monitor)][1]
+            else:
+                picture = outputs[0][1]
+            self.set_image(name, current, picture, mode)
+
+        from concurrent.futures import ThreadPoolExecutor
+        properties = self.get_properties()
+        with ThreadPoolExecutor(max_workers=max(1, len(properties))) as pool:
+            list(pool.map(assign, properties.items()))
+        return 0
+
+
+class CommandBackend(Backend):
+    """desktops set by a single program: feh, pcmanfm, osascript"""
+
+    def __init__(self, build):
+        self.build = build
+
+    def apply(self, picture, mode):
+        return run_command(self.build(picture, mode))
+
+
+class FehBackend(CommandBackend):
+    """feh, which takes one image per Xinerama screen, primary first"""
+
+    def __init__(self):
+        super(FehBackend, self).__init__(
+            lambda pic, mode: ['feh'] + mode_args(mode) + [pic])
+
+    def apply_outputs(self, outputs, mode):
+        return run_command(['feh'] + mode_args(mode) +
+                           [picture for screen, picture in outputs])
+
+
+class KdeBackend(Backend):
+    """KDE4 & 5, whose slideshow shows whatever image is in the folder; the
+    image is linked in under a fixed name and swapped by rename, so the
+    folder never holds a partial copy or no image at all"""
+    name = 'rwal-wallpaper'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def remove_legacy(self):
+        """remove images copied in by earlier versions of rwal"""
+        for pattern in ('*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG',
+                        '*.PNG'):
+            for previous in glob.glob(os.path.join(self.directory, pattern)):
+                os.remove(previous)
+
+    def link(self, picture, staging):
+        """hardlink, or symlink where the picture is on another filesystem
+        or the filesystem has no hardlinks"""
+        try:
+            os.remove(staging)  # left behind by an interrupted run
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(picture, staging)
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.ENOTSUP):
+                raise
+            os.symlink(os.path.abspath(picture), staging)
+
+    def apply(self, picture, mode):
+        extension = os.path.splitext(picture)[1].lower() or '.jpg'
+        target = os.path.join(self.directory, self.name + extension)
+        current = glob.glob(os.path.join(self.directory, self.name + '.*'))
+        if not current:
+            self.remove_legacy()
+        try:
+            # renaming a link over another link to the same file does
+            # nothing, which would leave the staged link in the folder
+            applied = os.path.samefile(target, picture)
+        except OSError:
+            applied = False
+        if not applied:
+            # the .tmp suffix keeps the slideshow from showing the staged
+            # link
+            staging = target + '.tmp'
+            self.link(picture, staging)
+            os.replace(staging, target)
+        for previous in current:
+            # an image of another type is dropped only once the new one is in
+            if previous != target and not previous.endswith('.tmp'):
+                os.remove(previous)
+        return 0
+
+
+class WindowsBackend(Backend):
+    def apply(self, picture, mode):
+        import ctypes
+        # SPI_SETDESKWALLPAPER, saved to the profile and broadcast
+        return ctypes.windll.user32.SystemParametersInfoW(0x14, 0, picture, 3)
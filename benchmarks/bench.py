@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Benchmarks rwal's library scan, aspect ratio filter, image selection,
+images list and background.conf stages against a synthetic library, and
+prints the timings as JSON; rwal runs with a scratch HOME, so the user's own
+configuration is never touched"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import itertools
+import statistics
+import contextlib
+from pathlib import Path
+from library import MTIME, generate, jpeg_bytes
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Suite:
+    """each benchmark is a name, an untimed setup and a timed run; stages
+    reuse the images found by earlier ones, collecting them if skipped"""
+
+    def __init__(self, library, picks, image_filter, seed):
+        from state import State
+        self.state = State()
+        self.state.set_state('filter', image_filter)
+        self.library = os.path.abspath(library)
+        self.picks = picks
+        self.rng = random.Random(seed)
+        self.listFile = Path(self.state.configDirectory, 'images.idx')
+        self.directories = sorted(root for root, dirnames, filenames
+                                  in os.walk(self.library))
+        self.images = None
+        self.filtered = None
+        self.slides = None
+        self.added = 0
+
+    def benchmarks(self):
+        return (('scan.cold', self.forget_index, self.scan),
+                ('scan.warm', None, self.scan),
+                ('scan.changed', self.add_image, self.scan),
+                ('filter.cold', self.forget_dimensions, self.filter),
+                ('filter.warm', None, self.filter),
+                ('select.random', None, self.select_random),
+                ('select.weighted', None, self.select_weighted),
+                ('select.shuffle', None, self.select_shuffle),
+                ('select.next', self.prepare_list, self.select_next),
+                ('list.write', self.remove_list, self.write_list),
+                ('list.write_unchanged', None, self.write_list),
+                ('list.lookup', self.prepare_list, self.lookup_list),
+                ('bgconf.read', self.unload_bgconf, self.read_bgconf),
+                ('bgconf.flush', None, self.flush_bgconf),
+                ('slideshow.tick', None, self.slideshow_tick))
+
+    """
+    SETUP
+    """
+
+    def get_images(self):
+        if self.images is None:
+            self.scan()
+        return self.images
+
+    def get_filtered(self):
+        if self.filtered is None:
+            self.filter()
+        return self.filtered
+
+    def forget_index(self):
+        from index import ImageIndex
+        index = ImageIndex()
+        index.close_index()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(str(index.indexFile))
+
+    def add_image(self):
+        """a new image in one directory, so one directory is rescanned"""
+        self.added += 1
+        directory = self.rng.choice(self.directories)
+        with open(os.path.join(directory, 'added{:06}.jpg'.format(
+                self.added)), 'wb') as image:
+            image.write(jpeg_bytes(1920, 1080))
+        # dated in the past, else the index rescans it on every refresh
+        os.utime(directory, (MTIME + self.added, MTIME + self.added))
+
+    def forget_dimensions(self):
+        from metadata import MetadataCache
+        db = MetadataCache().open_cache()
+        with db:
+            db.execute('DELETE FROM dimensions')
+
+    def remove_list(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(str(self.listFile))
+
+    def prepare_list(self):
+        from imagelist import ImageList
+        ImageList.write(self.listFile, self.get_filtered())
+        self.state.set_bgConfig('Indexed Background', self.get_filtered()[0])
+        self.state.set_bgConfig('Indexed Position', '0')
+
+    def unload_bgconf(self):
+        self.state.flush_bgConfig()
+        self.state.bgLoaded = False
+
+    """
+    TIMED STAGES
+    """
+
+    def scan(self):
+        from index import ImageIndex
+        self.images = ImageIndex().get_images(self.library)
+
+    def filter(self):
+        from images import ImageCollector
+        collector = ImageCollector()
+        collector.sourceImages = list(self.get_images())
+        collector.image_filter()
+        self.filtered = collector.sourceImages
+
+    def select(self, choose):
+        """picks as separate invocations make them: chosen from a new list,
+        validated, then indexed and recorded"""
+        from images import ImageCollector
+        collector = ImageCollector()
+        for pick in range(self.picks):
+            collector.selectedImage = choose(list(self.get_filtered()))
+            collector.get_image_type(collector.selectedImage)
+            collector.index_background()
+            collector.record_background()
+
+    def select_random(self):
+        self.select(random.choice)
+
+    def select_weighted(self):
+        from history import ShowHistory
+        self.select(ShowHistory().choose)
+
+    def select_shuffle(self):
+        from shuffle import ShuffleBag
+        from images import ImageCollector
+        source = ImageCollector().get_source_key()
+        self.select(lambda paths: ShuffleBag().choose(paths, source))
+
+    def select_next(self):
+        from images import ImageSelector
+        for pick in range(self.picks):
+            selector = ImageSelector()
+            selector.images.selectedImage = selector.select_next_image()
+            selector.images.index_background()
+
+    def write_list(self):
+        from imagelist import ImageList
+        ImageList.write(self.listFile, self.get_filtered())
+
+    def lookup_list(self):
+        from imagelist import ImageList
+        sample = self.rng.sample(self.get_filtered(),
+                                 min(self.picks, len(self.get_filtered())))
+        with ImageList(self.listFile) as imagesList:
+            for path in sample:
+                imagesList.index(path)
+
+    def read_bgconf(self):
+        self.state.get_bgConfig()
+
+    def flush_bgconf(self):
+        self.state.set_bgConfig('Current Background',
+                                self.rng.choice(self.get_filtered()))
+        self.state.flush_bgConfig()
+
+    def slideshow_tick(self):
+        """prepare and record one slide, as the slideshow does between
+        changes; the desktop itself is left alone"""
+        from slideshow import SlideShow
+        show = SlideShow()
+        if self.slides is None:
+            # corrupt files included, so skipping them is timed too
+            show.slides = list(self.get_images())
+            self.rng.shuffle(show.slides)
+            self.slides = (show.slides, itertools.cycle(show.slides))
+        show.slides = self.slides[0]
+        slide = show.prepare_slide(self.slides[1])
+        show.images.selectedImage = slide
+        show.images.index_background()
+        show.images.record_background()
+        show.flush_bgConfig()
+
+    def close(self):
+        """write anything buffered and release the index, before the scratch
+        directory is removed"""
+        from index import ImageIndex
+        self.state.flush_bgConfig()
+        ImageIndex().close_index()
+
+
+def measure(setup, run, repeat):
+    times = []
+    for attempt in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return dict(runs=[round(seconds, 6) for seconds in times],
+                min=round(min(times), 6),
+                median=round(statistics.median(times), 6),
+                mean=round(statistics.mean(times), 6))
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Time rwal stages against a synthetic image library and '
+                    'print the results as JSON.')
+    parser.add_argument('--library', metavar='DIRECTORY',
+                        help='benchmark an existing library instead of a '
+                             'generated one')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='files in the generated library (default: 1000)')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='directory levels (default: 2)')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories per directory (default: 4)')
+    parser.add_argument('--corrupt', type=float, default=0.02,
+                        help='fraction of corrupt images (default: 0.02)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs per benchmark (default: 5)')
+    parser.add_argument('--picks', type=int, default=100,
+                        help='selections or lookups per run (default: 100)')
+    parser.add_argument('--filter', default='hd1080,hd1050',
+                        help='aspect ratio filter (default: hd1080,hd1050)')
+    parser.add_argument('--jobs', type=int,
+                        help='worker threads for scanning and probing')
+    parser.add_argument('--only', metavar='PREFIXES',
+                        help='comma-separated benchmark name prefixes, such '
+                             'as scan,select.next')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the JSON report to FILE')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = get_args(argv)
+    only = tuple(args.only.split(',')) if args.only else ('',)
+    report = dict(
+        environment=dict(python=platform.python_version(),
+                         implementation=platform.python_implementation(),
+                         platform=platform.platform(),
+                         machine=platform.machine(), cpus=os.cpu_count()),
+        repeat=args.repeat, picks=args.picks, filter=args.filter,
+        results={})
+    with tempfile.TemporaryDirectory(prefix='rwal-bench-') as scratch:
+        # State reads HOME when imported, so rwal is imported only from here
+        os.environ['HOME'] = os.path.join(scratch, 'home')
+        os.environ['DESKTOP_SESSION'] = 'benchmark'
+        os.environ.pop('RWAL_SCREEN', None)
+        sys.path.insert(0, REPO)
+        if args.library:
+            library = args.library
+            report['library'] = dict(path=os.path.abspath(library))
+        else:
+            library = os.path.join(scratch, 'library')
+            report['library'] = dict(generate(
+                library, args.files, args.depth, args.fanout, args.corrupt,
+                args.seed), depth=args.depth, fanout=args.fanout,
+                seed=args.seed)
+        suite = Suite(library, args.picks, args.filter, args.seed)
+        suite.state.set_state('jobs', args.jobs)
+        try:
+            # rwal's own messages would interleave with the report
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                for name, setup, run in suite.benchmarks():
+                    if name.startswith(only):
+                        report['results'][name] = measure(setup, run,
+                                                          args.repeat)
+                report['library'].update(images=len(suite.get_images()),
+                                         filtered=len(suite.get_filtered()))
+        finally:
+            suite.close()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Module for generating synthetic image libraries to benchmark rwal against;
+the images are headers only, so libraries of any size are quick to build"""
+import os
+import sys
+import zlib
+import random
+import struct
+import argparse
+
+# common wallpaper and photo resolutions, covering every aspect ratio filter
+RESOLUTIONS = ((1920, 1080), (2560, 1440), (3840, 2160), (1366, 768),
+               (1920, 1200), (1680, 1050), (1024, 768), (1600, 1200),
+               (4096, 2160), (3840, 1080), (5120, 1440), (3440, 1440),
+               (1080, 1920), (2048, 2048), (6000, 4000))
+# every file and directory is dated 2020-01-01, as an untouched library
+MTIME = 1577836800
+
+
+def jpeg_bytes(width, height):
+    """SOI, a JFIF segment and a baseline frame header, then EOI"""
+    app0 = b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    frame = struct.pack('>BHHB', 8, height, width, 3) + \
+        b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+    return b''.join((b'\xff\xd8',
+                     b'\xff\xe0', struct.pack('>H', len(app0) + 2), app0,
+                     b'\xff\xc0', struct.pack('>H', len(frame) + 2), frame,
+                     b'\xff\xd9'))
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_bytes(width, height):
+    """signature, an 8-bit RGB header chunk, then the end chunk"""
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + \
+        png_chunk(b'IEND', b'')
+
+
+def make_directories(root, depth, fanout):
+    """root and every directory of a tree depth levels deep, fanout wide"""
+    directories, level = [root], [root]
+    for current in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(branch))
+                 for parent in level for branch in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+
+def generate(root, files=1000, depth=2, fanout=4, corrupt=0.02, seed=0):
+    """write a library of files images under root; corrupt is the fraction
+    of .jpg files that hold no image, and one in fifty files is not an
+    image at all. The same arguments always produce the same library.
+    Returns counts of what was written."""
+    rng = random.Random(seed)
+    directories = make_directories(root, depth, fanout)
+    counts = dict(files=files, directories=len(directories), jpeg=0, png=0,
+                  corrupt=0, other=0)
+    for number in range(files):
+        directory = rng.choice(directories)
+        width, height = rng.choice(RESOLUTIONS)
+        draw = rng.random()
+        if draw < corrupt:
+            name, data = 'c{:06}.jpg'.format(number), bytes(
+                rng.getrandbits(8) for byte in range(64))
+            counts['corrupt'] += 1
+        elif draw < corrupt + 0.02:
+            name, data = 'n{:06}.txt'.format(number), b'notes\n'
+            counts['other'] += 1
+        elif rng.random() < 0.75:
+            name = 'p{:06}.{}'.format(number, rng.choice(('jpg', 'jpeg')))
+            data = jpeg_bytes(width, height)
+            counts['jpeg'] += 1
+        else:
+            name, data = 'p{:06}.png'.format(number), png_bytes(width, height)
+            counts['png'] += 1
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as image:
+            image.write(data)
+        os.utime(path, (MTIME, MTIME))
+    # deepest first, since creating an entry updates its parent
+    for directory in reversed(directories):
+        os.utime(directory, (MTIME, MTIME))
+    return counts
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic image library for benchmarks.')
+    parser.add_argument('root', help='directory to write the library into')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of files (default: 1000)')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='directory levels below root (default: 2)')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories per directory (default: 4)')
+    parser.add_argument('--corrupt', type=float, default=0.02,
+                        help='fraction of corrupt images (default: 0.02)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = get_args(argv)
+    counts = generate(args.root, args.files, args.depth, args.fanout,
+                      args.corrupt, args.seed)
+    print('generated {files} files in {directories} directories: {jpeg} '
+          'JPEG, {png} PNG, {corrupt} corrupt, {other} other'.format(**counts))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Module for writing and reading the rwal configuration files"""
 import os, sys, subprocess
+import instrument
 from state import State
 from pathlib import Path
 from textwrap import dedent
@@ -48,6 +49,31 @@ class Config(State):
             self.config.set('Defaults', 'Default Background Editor', 'gimp')
             self.config.set('Defaults', 'Default Directory',
                             '{}'.format(default))
+            # threads used to scan directories and read image headers
+            self.config.set('Defaults', 'Jobs', '4')
+            # seconds between directory checks when inotify is unavailable
+            self.config.set('Defaults', 'Poll Interval', '60')
+            # seconds between slideshow image rescans; 0 rescans only when a
+            # watched directory changes
+            self.config.set('Defaults', 'Slideshow Refresh', '0')
+            # how random images are picked: random, weighted toward images
+            # not shown for the longest time, or shuffle to show every image
+            # once before repeating any
+            self.config.set('Defaults', 'Selection Mode', 'random')
+            # apply copies scaled to the screen, kept in ~/.cache/rwal/render
+            # up to Render Cache Size megabytes; requires Pillow
+            self.config.set('Defaults', 'Render Cache', 'no')
+            self.config.set('Defaults', 'Render Cache Size', '256')
+            # a different image on each monitor, matched to its aspect ratio
+            self.config.set('Defaults', 'Per Monitor', 'no')
+            # show one image of each group of near-duplicates, such as
+            # resized copies; Duplicate Threshold is the number of differing
+            # perceptual hash bits, of 64, still counted as a duplicate
+            self.config.set('Defaults', 'Dedupe', 'no')
+            self.config.set('Defaults', 'Duplicate Threshold', '6')
+            # file each run's --stats report is appended to, as JSON lines,
+            # rolled over at 1 MB; empty to keep no log
+            self.config.set('Defaults', 'Stats Log', '')
 
             # wallpaper mode settings
             self.config.add_section('Wallpaper Modes')
@@ -56,8 +82,12 @@ class Config(State):
             self.config.set('Wallpaper Modes',
                             dedent("""\
             # Aspect Ratio Filter Options:
-            # sd480, hd1050, hd1080, hd1050x2, hd1080x2, and auto"""))
+            # sd480, hd1050, hd1080, hd1050x2, hd1080x2, auto, or W:H;
+            # separate several with commas, e.g. hd1080,dci4k"""))
             self.config.set('Wallpaper Modes', 'Aspect Ratio Filter', 'none')
+            # relative difference from a filter ratio still accepted, so that
+            # 1366x768 passes as hd1080
+            self.config.set('Wallpaper Modes', 'Aspect Ratio Tolerance', '0.01')
             self.config.set('Wallpaper Modes',
                             dedent("""\n\
             # Wallpaper Mode Settings by Environment:
@@ -97,6 +127,7 @@ class Config(State):
                             '{}'.format(default))
             self.config.set('Preset Image Directories', 'Directory5',
                             '{}'.format(default))
+            instrument.count('config_write')
             with open(str(self.configFile), 'w') as configfile:
                 self.config.write(configfile)
 
@@ -109,7 +140,9 @@ class Config(State):
                 If you need help, type rwal.py -h in a terminal."""))
         else:
             # open config file for reading if it already exists
+            instrument.count('config_read')
             self.config.read(str(self.configFile))
+            self.configLoaded = True
             # config getter vars assigned here when used more than once
 
     def set_bgconfig(self):
@@ -119,24 +152,42 @@ class Config(State):
         # check for existence of background config file, create if absent
         if not self.bgFile.is_file():
             # for process use
-            self.bgConfig.add_section('Temp')
-            self.bgConfig.set('Temp', 'Current Directory', '')
-            self.bgConfig.set('Temp', 'Current Background', '')
-            self.bgConfig.set('Temp', 'Indexed Background', '')
-            with open(str(self.bgFile), 'w') as configfile:
-                # open bgconfig file for reading if it already exists
-                self.bgConfig.write(configfile)
-                # bgconfig accessors assigned vars here when used more than
-                # once
+            self.set_bgConfig('Current Directory', '')
+            self.set_bgConfig('Current Background', '')
+            self.set_bgConfig('Indexed Background', '')
+            self.flush_bgConfig()
 
             print(
                 'created background configuration file: {}'.format(self.bgFile))
         else:
-            self.bgConfig.read(str(self.bgFile))
+            self.read_bgConfig()
+
+    def get_watch_directories(self):
+        """existing default and preset directories, without nested repeats"""
+        self.read_config()
+        candidates = [self.config.get('Defaults', 'Default Directory',
+                                      fallback='')]
+        candidates += [self.config.get('Preset Image Directories',
+                                       'Directory{}'.format(number),
+                                       fallback='') for number in range(1, 6)]
+        directories = []
+        for directory in sorted({os.path.abspath(d) for d in candidates if d}):
+            if not Path(directory).is_dir():
+                continue
+            if not any(directory.startswith(parent.rstrip(os.sep) + os.sep)
+                       for parent in directories):
+                directories.append(directory)
+        return directories
+
+    def get_stats_log(self):
+        """file stats reports are appended to, or '' for none"""
+        self.read_config()
+        return self.config.get('Defaults', 'Stats Log', fallback='')
 
     def edit_config(self):
         self.set_config()
         edit_conf = self.config.get('Defaults', 'Default Config Editor')
+        instrument.count('subprocess')
         return subprocess.run(
             '{} {}/rwal.conf'.format(edit_conf, self.configDirectory),
             shell=True)
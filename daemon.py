@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Module for running rwal as a long-lived daemon that applies backgrounds on
+request from a local socket, and for sending it those requests"""
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import contextlib
+from pathlib import Path
+from state import State
+
+
+class Daemon(State):
+    """serve rwal commands over a UNIX socket in the config directory"""
+
+    def __init__(self):
+        super(Daemon, self).__init__()
+        self.socketPath = str(Path(self.configDirectory, 'rwal.sock'))
+
+    def connect(self):
+        """socket connected to a running daemon, or None if there is none"""
+        if not hasattr(socket, 'AF_UNIX') or \
+                not os.path.exists(self.socketPath):
+            return None
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socketPath)
+        except OSError:  # stale socket left by a daemon that died
+            client.close()
+            return None
+        return client
+
+    def send_command(self, argv):
+        """forward a commandline to the daemon; returns its exit status, or
+        None if no daemon is listening"""
+        client = self.connect()
+        if client is None:
+            return None
+        request = dict(argv=list(argv), cwd=os.getcwd())
+        with client, client.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            reply = stream.readline()
+        if not reply:
+            return None
+        reply = json.loads(reply.decode('utf-8'))
+        sys.stdout.write(reply['stdout'])
+        sys.stderr.write(reply['stderr'])
+        return reply['status']
+
+    def handle(self, connection, dispatch):
+        """run one request through dispatch, capturing its output"""
+        with connection, connection.makefile('rwb') as stream:
+            request = json.loads(stream.readline().decode('utf-8'))
+            stdout, stderr = io.StringIO(), io.StringIO()
+            status = 0
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                try:
+                    os.chdir(request['cwd'])
+                    dispatch(request['argv'])
+                except SystemExit as done:
+                    # mirror the interpreter's handling of sys.exit()
+                    if isinstance(done.code, int):
+                        status = done.code
+                    elif done.code is not None:
+                        print(done.code, file=sys.stderr)
+                        status = 1
+                except Exception as error:
+                    print('rwal daemon error: {}'.format(error),
+                          file=sys.stderr)
+                    status = 1
+            reply = dict(stdout=stdout.getvalue(), stderr=stderr.getvalue(),
+                         status=status)
+            stream.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def serve(self, dispatch):
+        """accept requests until interrupted; dispatch receives argv"""
+        if not hasattr(socket, 'AF_UNIX'):
+            sys.exit('The rwal daemon requires UNIX domain sockets.')
+        probe = self.connect()
+        if probe is not None:
+            probe.close()
+            sys.exit('rwal daemon already running: {}'.format(self.socketPath))
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        server.listen(8)
+        # let SIGTERM unwind through the cleanup below, like Ctrl-C
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, terminate)
+        self.set_state('daemon', True)
+        if self._state['verbose']:
+            print('rwal daemon listening on {}'.format(self.socketPath))
+        try:
+            while True:
+                connection, address = server.accept()
+                try:
+                    self.handle(connection, dispatch)
+                except (OSError, ValueError, KeyError) as error:
+                    print('rwal daemon dropped request: {}'.format(error),
+                          file=sys.stderr)
+        except KeyboardInterrupt:
+            print('rwal daemon stopped.')
+        finally:
+            server.close()
+            os.remove(self.socketPath)
@@ -1,21 +1,28 @@
 #!/usr/bin/env python3
 """
-Library for detecting the host environment then building and executing wallpaper
-commands
+Library for detecting the host environment then applying wallpapers through
+its backend
 """
 import sys
 import os
-import subprocess
-import ctypes
+import instrument
 from state import State
+from render import RenderCache
+from backends import GSettingsBackend, XfconfBackend, CommandBackend, \
+    FehBackend, KdeBackend, WindowsBackend, mode_args
 
 
 class Environment(State):
-    """ detect desktop environment and produce background command string"""
+    """ detect desktop environment and apply the background through its
+    backend"""
 
     def __init__(self):
         super(Environment, self).__init__()
         self.pic = None
+        if 'backends' not in self._state:
+            self.backends = {}
+        # (screen, picture) pairs while applying an image per monitor
+        self.outputs = None
         if 'APPDATA' in os.environ:
             self.desktopSession = 'windows'
         else:
@@ -51,40 +58,50 @@ class Environment(State):
 
     def get_mode(self, desktop):
         """check and apply user-defined mode format; use fallback if invalid"""
-        self.config.read(str(self.configFile))
-        
+        # parsed once per run by Config.set_config(), not on every apply
+        self.read_config()
+
         gnomeMode = ('none', 'centered', 'scaled', 'spanned', 'stretched',
                      'wallpaper', 'zoom')
         if desktop == 'cinnamon':
-            image_config = self.config.get(
-                'Wallpaper Modes', 'Cinnamon', fallback='scaled')
-            mode = gnomeMode
+            option, fallback, mode = 'Cinnamon', 'scaled', gnomeMode
         elif desktop == 'gnome':
-            image_config = self.config.get(
-                'Wallpaper Modes', 'GNOME', fallback='scaled')
-            mode = gnomeMode
+            option, fallback, mode = 'GNOME', 'scaled', gnomeMode
         elif desktop == 'mate':
-            image_config = self.config.get(
-                'Wallpaper Modes', 'MATE', fallback='scaled')
-            mode = gnomeMode
+            option, fallback, mode = 'MATE', 'scaled', gnomeMode
         elif desktop == 'xfce':
-            image_config = self.config.get(
-                'Wallpaper Modes', 'Xfce', fallback='4')
+            option, fallback = 'Xfce', '4'
             mode = ('0', '1', '2', '3', '4', '5')
         elif desktop == 'lxde':
-            image_config = self.config.get(
-                'Wallpaper Modes', 'LXDE', fallback='scaled')
+            option, fallback = 'LXDE', 'scaled'
             mode = ('tiled', 'center', 'scaled', 'fit', 'stretch')
         else:
-            image_config = self.config.get(
-                'Wallpaper Modes', 'Openbox', fallback='--bg-max')
+            option, fallback = 'Openbox', '--bg-max'
             mode = ('--bg-max', '--bg-scale', '--bg-tile', '--bg-fill',
                     '--bg-center')
+        image_config = self.config.get('Wallpaper Modes', option,
+                                       fallback=fallback)
         if image_config in mode:
             self._state['mode'] = image_config
-            return self._state['mode']
         else:
             print(self._state['mode_error'])
+            self._state['mode'] = fallback
+        return self._state['mode']
+
+    def get_backend(self, name, build):
+        """backends are built once per process, so that a daemon or slideshow
+        keeps its service connections between changes"""
+        if name not in self.backends:
+            # D-Bus sessions only pay for their setup when reused
+            persistent = self._state['daemon'] or self._state['slideshow']
+            self.backends[name] = build(persistent)
+        return self.backends[name]
+
+    def apply(self, backend, mode):
+        """apply pic, or one picture per monitor when outputs are set"""
+        if self.outputs:
+            return backend.apply_outputs(self.outputs, mode)
+        return backend.apply(self.get_state('pic'), mode)
 
     def set_gnome3(self):
         # set GNOME 3 background for Gnome Shell, Cinnamon, and Unity
@@ -92,81 +109,108 @@ class Environment(State):
             self.get_mode('cinnamon')
         else:
             self.get_mode('gnome')
-        gnome3 = \
-            'gsettings set org.gnome.desktop.background picture-options\
-            {};'.format(self._state['mode']) + \
-            'gsettings set org.gnome.desktop.background picture-uri \
-            \'file://{}\''.format(self.get_state('pic'))
-        return gnome3
+        gnome3 = self.get_backend('gnome', lambda persistent: GSettingsBackend(
+            'org.gnome.desktop.background', 'picture-uri', True, persistent))
+        return self.apply(gnome3, self._state['mode'])
 
     def set_mate(self):
         self.get_mode('mate')
-        mate = \
-            'gsettings set org.mate.background picture-options {0}; \
-            gsettings set org.mate.background picture-filename \
-            \'{1}\''.format(self._state['mode'], self.get_state('pic'))
-        return mate
+        mate = self.get_backend('mate', lambda persistent: GSettingsBackend(
+            'org.mate.background', 'picture-filename', False, persistent))
+        return self.apply(mate, self._state['mode'])
 
     def set_kde(self):
         # set KDE4 & 5
-        kde = \
-            'rm $(find {1} -type f \
-            -iregex ".*\.\(jpg\|png\|jpeg\)$") 2> /dev/null ;\
-            cp {0} {1}/'.format(self.get_state('pic'), self.configDirectory)
-        return kde
+        kde = self.get_backend('kde', lambda persistent: KdeBackend(
+            self.configDirectory))
+        return self.apply(kde, None)
 
     def set_xfce(self):
-        # Shell string by Peter Levi, http://peterlevi.com/variety/
         self.get_mode('xfce')
-        xfce = \
-            """for i in $(xfconf-query -c xfce4-desktop -p /backdrop -l|egrep \
-                -e "screen.*/monitor.*image-path$" \
-                -e "screen.*/monitor.*/last-image$"); do
-                    xfconf-query -c xfce4-desktop -p $i -n \
-                    -t string -s "" 2> /dev/null
-                    xfconf-query -c xfce4-desktop -p $i -s "{0}" 2> /dev/null
-                    xfconf-query -c xfce4-desktop -p $i -s "{1}" 2> /dev/null
-            done""".format(self._state['mode'], self.get_state('pic'))
-        return xfce
+        xfce = self.get_backend('xfce', XfconfBackend)
+        return self.apply(xfce, self._state['mode'])
 
     def set_lxde(self):
         self.get_mode('lxde')
-        lxde = 'pcmanfm --set-wallpaper \'{}\' \
-        --wallpaper-mode={}'.format(self.get_state('pic'), self._state['mode'])
-        return lxde
+        lxde = self.get_backend('lxde', lambda persistent: CommandBackend(
+            lambda pic, mode: ['pcmanfm', '--set-wallpaper', pic] +
+            mode_args(mode, '--wallpaper-mode={}')))
+        return self.apply(lxde, self._state['mode'])
 
     def set_openbox(self):
         # Openbox and other *nix window managers
         if self.depends['feh'][1]:
             self.get_mode('openbox')
-            openbox = 'feh {} \'{}\''.format(self._state['mode'],
-                                             self.get_state('pic'))
-            return openbox
+            openbox = self.get_backend('openbox',
+                                       lambda persistent: FehBackend())
+            return self.apply(openbox, self._state['mode'])
         else:
             print('Openbox and any undetected environs require feh.')
 
     def set_windows(self):
-        # Note: in Python3, strings passed to windll must be encoded as ascii
-        windows = ctypes.windll.user32.SystemParametersInfoA(0x14, 0,
-                                                             self.get_state(
-                                                                 'pic').encode(
-                                                                 'ascii'), 3)
-        return windows
+        windows = self.get_backend('windows', lambda persistent:
+                                   WindowsBackend())
+        return self.apply(windows, None)
 
     def set_mac(self):
-        applescript = """/usr/bin/osascript<<END
-        tell application "Finder"
-        set desktop picture to POSIX file "{}"
-        end tell
-        END""".format(self.get_state('pic'))
-        return applescript
+        mac = self.get_backend('mac', lambda persistent: CommandBackend(
+            lambda pic, mode: ['/usr/bin/osascript', '-e',
+                               'tell application "Finder" to set desktop '
+                               'picture to POSIX file "{}"'.format(pic)]))
+        return self.apply(mac, None)
+
+    def get_render_mode(self):
+        """wallpaper mode the image is rendered for; None where the mode is
+        chosen outside rwal, as in KDE"""
+        if self.desktopSession in self.gnomeEnv:
+            if os.environ.get('DESKTOP_SESSION') == 'cinnamon':
+                return self.get_mode('cinnamon')
+            return self.get_mode('gnome')
+        elif 'plasma' in self.desktopSession or 'APPDATA' in os.environ or \
+                'Apple_PubSub_Socket_Render' in os.environ:
+            return None
+        elif self.desktopSession in ('mate', 'xfce'):
+            return self.get_mode(self.desktopSession)
+        elif self.desktopSession == 'LXDE':
+            return self.get_mode('lxde')
+        return self.get_mode('openbox')
 
     def set_background(self):
-        """executes appropriate environment command to set wallpaper"""
-        if 'APPDATA' in os.environ:
-            return self.set_desktop()
-        else:
-            return subprocess.run(self.set_desktop(), shell=True)
+        """executes appropriate environment command to set wallpaper,
+        optionally with a copy rendered at the screen's resolution"""
+        picture = self.get_state('pic')
+        render = RenderCache()
+        if render.is_enabled():
+            with instrument.span('render'):
+                self.set_state('pic', render.render(picture,
+                                                    self.get_render_mode()))
+        try:
+            with instrument.span('desktop'):
+                return self.set_desktop()
+        finally:
+            # the original stays the recorded and indexed background
+            self.set_state('pic', picture)
+
+    def set_monitor_backgrounds(self, outputs):
+        """apply a (screen, picture) pair per monitor in one pass, rendering
+        them concurrently if the render cache is on"""
+        render = RenderCache()
+        if render.is_enabled():
+            from concurrent.futures import ThreadPoolExecutor
+            mode = self.get_render_mode()
+            with instrument.span('render'), \
+                    ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+                rendered = list(pool.map(
+                    lambda output: render.render(output[1], mode, output[0]),
+                    outputs))
+            outputs = [(screen, picture) for (screen, image), picture
+                       in zip(outputs, rendered)]
+        self.outputs = outputs
+        try:
+            with instrument.span('desktop'):
+                return self.set_desktop()
+        finally:
+            self.outputs = None
 
 
 def main(argv):
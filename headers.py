@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Module for reading image type and dimensions from file headers, without
+decoding the image"""
+import struct
+import instrument
+
+# JPEG start-of-frame markers; C4, C8 and CC share the range but are not frames
+SOF_MARKERS = set(range(0xC0, 0xD0)).difference((0xC4, 0xC8, 0xCC))
+# JPEG markers that stand alone, without a length field
+BARE_MARKERS = set(range(0xD0, 0xDA)).union((0x01,))
+# Pillow format names mapped to imghdr-style type names
+PIL_TYPES = dict(JPEG='jpeg', PNG='png', BMP='bmp', GIF='gif', TIFF='tiff',
+                 MPO='jpeg')
+
+
+def read_png(head, file):
+    if head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+
+
+def read_gif(head, file):
+    return struct.unpack('<HH', head[6:10])
+
+
+def read_bmp(head, file):
+    if struct.unpack('<I', head[14:18])[0] == 12:  # OS/2 core header
+        return struct.unpack('<HH', head[18:22])
+    width, height = struct.unpack('<ii', head[18:26])
+    return width, abs(height)  # negative height means top-down rows
+
+
+def read_tiff(head, file):
+    order = '<' if head[:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', head[4:8])[0]
+    file.seek(offset)
+    count = struct.unpack(order + 'H', file.read(2))[0]
+    entries = file.read(count * 12)
+    size = {}
+    for start in range(0, len(entries) - 11, 12):
+        tag, kind = struct.unpack(order + 'HH', entries[start:start + 4])
+        if tag in (256, 257):  # ImageWidth, ImageLength
+            value = entries[start + 8:start + 12]
+            if kind == 3:  # SHORT
+                size[tag] = struct.unpack(order + 'H', value[:2])[0]
+            elif kind == 4:  # LONG
+                size[tag] = struct.unpack(order + 'I', value)[0]
+    if 256 in size and 257 in size:
+        return size[256], size[257]
+
+
+def read_jpeg(head, file):
+    """walk segment headers to the first frame, seeking over the payloads"""
+    file.seek(2)
+    while True:
+        byte = file.read(1)
+        if byte != b'\xff':
+            return None
+        marker = file.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = file.read(1)
+        if not marker:
+            return None
+        marker = ord(marker)
+        if marker in BARE_MARKERS:
+            continue
+        length = file.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in SOF_MARKERS:
+            frame = file.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        file.seek(length - 2, 1)
+
+
+# magic prefix, type name, dimension reader
+READERS = ((b'\x89PNG\r\n\x1a\n', 'png', read_png),
+           (b'\xff\xd8', 'jpeg', read_jpeg),
+           (b'GIF87a', 'gif', read_gif),
+           (b'GIF89a', 'gif', read_gif),
+           (b'BM', 'bmp', read_bmp),
+           (b'II*\x00', 'tiff', read_tiff),
+           (b'MM\x00*', 'tiff', read_tiff))
+
+
+def read_header(path):
+    """(type, width, height) from the file header, or None if unrecognized;
+    raises OSError if the file cannot be opened"""
+    with open(path, 'rb') as file:
+        instrument.count('open')
+        head = file.read(32)
+        for magic, kind, reader in READERS:
+            if head.startswith(magic):
+                try:
+                    size = reader(head, file)
+                except (struct.error, OSError):
+                    size = None
+                if size and all(size):
+                    return (kind,) + tuple(size)
+                return None
+    return None
+
+
+def read_pillow(path):
+    """(type, width, height) via Pillow, for files the header reader can't
+    parse; None if Pillow is absent or can't identify the file"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    instrument.count('open')
+    try:
+        with Image.open(path) as im:
+            kind = PIL_TYPES.get(im.format, str(im.format).lower())
+            return (kind,) + im.size
+    except (IOError, SyntaxError, ValueError):
+        return None
+
+
+def probe_image(path):
+    """(type, width, height) of an image, None if it is corrupt or not an
+    image; raises OSError if the file cannot be opened"""
+    return read_header(path) or read_pillow(path)
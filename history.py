@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Module for remembering when each image was last applied, so that random
+selection can favour images that haven't been seen in a long time"""
+import time
+import random
+from state import State
+from index import ImageIndex
+
+# images last shown longer ago than this are as likely as never-shown ones
+HORIZON = 365 * 24 * 3600
+# weight of an image that was just shown, so that it can still come up
+MINIMUM_WEIGHT = 60
+# seconds a kept tree's weights are used before they are recomputed
+REFRESH = 600
+
+
+class FenwickTree:
+    """binary indexed tree of weights, for O(log n) weighted picks and
+    weight updates without rebuilding"""
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.size = len(self.weights)
+        self.tree = [0] + self.weights
+        # O(n) construction: push each partial sum to its parent once
+        for node in range(1, self.size + 1):
+            parent = node + (node & -node)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[node]
+        self.total = sum(self.weights)
+
+    def update(self, position, weight):
+        delta = weight - self.weights[position]
+        self.weights[position] = weight
+        self.total += delta
+        node = position + 1
+        while node <= self.size:
+            self.tree[node] += delta
+            node += node & -node
+
+    def find(self, value):
+        """position whose cumulative weight range contains value"""
+        node, step = 0, 1 << self.size.bit_length()
+        while step:
+            child = node + step
+            if child <= self.size and self.tree[child] <= value:
+                node = child
+                value -= self.tree[child]
+            step >>= 1
+        return min(node, self.size - 1)
+
+    def choice(self):
+        return self.find(random.uniform(0, self.total))
+
+
+class ShowHistory(State):
+    """last-shown time and show count per image, stored in library.db"""
+
+    def __init__(self):
+        super(ShowHistory, self).__init__()
+        # weights of the most recent source, kept between picks
+        if 'historyTree' not in self._state:
+            self.historyTree = None
+            self.historyPaths = None
+            self.historySource = None
+            self.historyPositions = None
+            self.historyBuilt = None
+
+    def open_history(self):
+        db = ImageIndex().open_index()
+        db.execute("""CREATE TABLE IF NOT EXISTS history (
+            path TEXT PRIMARY KEY, last_shown REAL, count INTEGER)""")
+        return db
+
+    def record(self, path):
+        """note that path was applied just now"""
+        with ImageIndex().indexLock:
+            db = self.open_history()
+            with db:
+                db.execute('INSERT OR IGNORE INTO history VALUES (?, 0, 0)',
+                           (path,))
+                db.execute('UPDATE history SET last_shown = ?, '
+                           'count = count + 1 WHERE path = ?',
+                           (time.time(), path))
+        # a kept tree has only the shown image's weight to change
+        if self.historyPositions and path in self.historyPositions:
+            self.historyTree.update(self.historyPositions[path],
+                                    MINIMUM_WEIGHT)
+
+    def get_history(self):
+        """map of path to (last_shown, count); the history only holds images
+        that have been shown, so it is read whole"""
+        with ImageIndex().indexLock:
+            return {path: (shown, count) for path, shown, count in
+                    self.open_history().execute('SELECT * FROM history')}
+
+    @staticmethod
+    def weight(last_shown, now):
+        return max(MINIMUM_WEIGHT, min(HORIZON, now - last_shown))
+
+    def get_tree(self, paths, source=None):
+        """weights of paths, built once per source; the list is compared
+        too, since a source's images can change, and the weights are
+        recomputed every REFRESH seconds as the times since shown grow"""
+        now = time.time()
+        if self.historySource != source or self.historyPaths != paths or \
+                now - self.historyBuilt > REFRESH:
+            history = self.get_history()
+            self.historyTree = FenwickTree(
+                self.weight(history[path][0], now) if path in history
+                else HORIZON for path in paths)
+            self.historyPaths, self.historySource = list(paths), source
+            self.historyPositions = {path: position for position, path
+                                     in enumerate(self.historyPaths)}
+            self.historyBuilt = now
+        return self.historyTree
+
+    def choose(self, paths, source=None):
+        """pick from paths with probability proportional to the time since
+        each was last shown; never-shown images weigh the most. A source,
+        such as the key of ImageCollector.get_source_images(), keeps its
+        weights for the next pick."""
+        tree = self.get_tree(paths, source)
+        position = tree.choice()
+        # lower the weight at once, for repeated picks from the same list
+        tree.update(position, MINIMUM_WEIGHT)
+        return paths[position]
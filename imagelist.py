@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Module for storing the sorted images list in a compact, memory-mapped
+binary file, so that next/previous can seek straight to an entry"""
+import os
+import mmap
+import struct
+
+MAGIC = b'RWIL'
+VERSION = 2
+# magic, version, number of paths, content digest, generation counter
+HEADER = struct.Struct('<4sII16sQ')
+OFFSET = struct.Struct('<Q')
+
+
+def encode(path):
+    return path.encode('utf-8', 'surrogateescape')
+
+
+class ImageList:
+    """read-only view of a sorted, duplicate-free list of image paths; the
+    file holds a header, a table of count + 1 offsets into the path blob,
+    then the UTF-8 paths back to back"""
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        with open(self.filename, 'rb') as listfile:
+            # mapped pages are read on demand; nothing is parsed up front
+            self.map = mmap.mmap(listfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.count, self.digest, self.generation = \
+                HEADER.unpack_from(self.map)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError('{} is not an rwal image list'.format(filename))
+        self.blob = HEADER.size + OFFSET.size * (self.count + 1)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, position):
+        """raw bytes of the path at position"""
+        start, end = struct.unpack_from(
+            '<QQ', self.map, HEADER.size + OFFSET.size * position)
+        return self.map[self.blob + start:self.blob + end]
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError('image list index out of range')
+        return self.entry(position).decode('utf-8', 'surrogateescape')
+
+    def bisect(self, path):
+        """position of path, or of where it would be inserted"""
+        target, low, high = encode(path), 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+    def export(self, filename):
+        """write the list as newline-separated text, as read by -l"""
+        with open(str(filename), 'w', encoding='utf-8',
+                  errors='surrogateescape') as textfile:
+            for path in self:
+                print(path, file=textfile)
+
+    def index(self, path):
+        position = self.bisect(path)
+        if position < self.count and self[position] == path:
+            return position
+        raise ValueError('{} is not in the image list'.format(path))
+
+    @staticmethod
+    def read_header(filename):
+        """(digest, generation) of an existing list, or (None, 0)"""
+        try:
+            with open(str(filename), 'rb') as listfile:
+                magic, version, count, digest, generation = HEADER.unpack(
+                    listfile.read(HEADER.size))
+        except (OSError, struct.error):
+            return None, 0
+        if magic != MAGIC or version != VERSION:
+            return None, 0
+        return digest, generation
+
+    @staticmethod
+    def write(filename, images):
+        """store images sorted and without duplicates; the file is left
+        untouched if its contents would not change, and otherwise replaced
+        atomically. Returns whether the file was written."""
+        import hashlib, tempfile
+        entries = sorted({encode(image) for image in images})
+        digest = hashlib.blake2b(b'\0'.join(entries), digest_size=16)
+        digest.update(struct.pack('<Q', len(entries)))
+        digest = digest.digest()
+        current, generation = ImageList.read_header(filename)
+        if digest == current:
+            return False
+        offsets, total = [0], 0
+        for entry in entries:
+            total += len(entry)
+            offsets.append(total)
+        directory = os.path.dirname(os.path.abspath(str(filename)))
+        descriptor, staging = tempfile.mkstemp(dir=directory,
+                                               prefix='.images.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as listfile:
+                listfile.write(HEADER.pack(MAGIC, VERSION, len(entries),
+                                           digest, generation + 1))
+                listfile.write(struct.pack('<{}Q'.format(len(offsets)),
+                                           *offsets))
+                listfile.write(b''.join(entries))
+            # readers see either the old list or the new one, never a mix
+            os.replace(staging, str(filename))
+        except BaseException:
+            os.remove(staging)
+            raise
+        return True
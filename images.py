@@ -2,25 +2,43 @@
 """Module for collecting and selecting images from various sources"""
 import sys
 import os
+import time
 import random
-import imghdr
+import sqlite3
 import subprocess
 from textwrap import dedent
-import tkinter as tk
-from fractions import Fraction
 from pathlib import Path
-from PIL import Image
+import instrument
 from state import State
+from index import ImageIndex
+from metadata import MetadataCache
+from headers import probe_image
+from imagelist import ImageList
+from screen import ScreenGeometry
+from history import ShowHistory
+from shuffle import ShuffleBag
+from phash import DuplicateIndex
 
 
 class ImageCollector(State):
     """image acquisition library employed by environment module"""
+    # filtered source lists kept in memory by the daemon, and their lifetime
+    # in seconds
+    _sourceCache = {}
+    sourceLifetime = 60
+    # aspect ratio filters, named for a popular resolution of each ratio
+    aspectRatios = dict(sd480=4 / 3, hd1050=8 / 5, hd1080=16 / 9,
+                        dci4k=256 / 135, hd1050x2=16 / 5, hd1080x2=32 / 9,
+                        dci4kx2=512 / 135)
 
     def __init__(self):
         super(ImageCollector, self).__init__()
         # self.selector = ImageSelector()
         self.sourceImages = []
+        # dimensions fetched by image_filter(), reused per monitor
+        self.sourceDimensions = None
         self.selectedImage = None
+        self.selectedPosition = None
 
     def change_directory(self, directory):
         """reads config or commandline for directories, then checks path
@@ -53,35 +71,70 @@ class ImageCollector(State):
 
     def record_dir(self):
         """records background image path to background.conf"""
-        self.read_bgConfig()
-        self.bgConfig.set('Temp', 'Current Directory', self.imageDirectory)
-        with open(str(self.bgFile), 'w') as configfile:
-            self.bgConfig.write(configfile)
+        self.set_bgConfig('Current Directory', self.imageDirectory)
 
     """
     IMAGE ACQUISITION FUNCTIONS
     """
 
+    def get_source_key(self):
+        """identifies the options that determine the source images"""
+        return (getattr(self, 'imageDirectory', None), self._state['list'],
+                self._state['pwd'], self._state['filter'],
+                self._state['monitor'], self._state['tolerance'],
+                self._state['min_width'], self._state['min_height'],
+                self._state['per_monitor'], self._state['dedupe'])
+
     def get_source_images(self):
         """create list of images from given directory or images list file"""
+        key = self.get_source_key()
+        cached = self._sourceCache.get(key)
+        # a daemon reuses recently collected lists between requests; lists
+        # from watched directories stay valid until a change is reported
+        if self._state['daemon'] and cached and not self._state['rescan'] \
+                and (time.monotonic() - cached[0] < self.sourceLifetime or
+                     not self._state['list'] and ImageIndex().is_watched(
+                         os.path.abspath(self.imageDirectory))):
+            self.sourceImages = list(cached[1])
+            self.sourceDimensions = cached[2]
+        else:
+            with instrument.span('collect'):
+                self.collect_images()
+            if self._state['daemon']:
+                self._sourceCache[key] = (time.monotonic(),
+                                          list(self.sourceImages),
+                                          self.sourceDimensions)
+
+        # prevent runaway rewrites of images.idx during slideshow
+        if not self._state['slideshow']:
+            with instrument.span('write list'):
+                self.write_images_list_file()
+        return self.sourceImages
+
+    def invalidate(self, path):
+        """drop in-memory lists of directories containing a changed path"""
+        for key in list(self._sourceCache):
+            if key[1] or key[0] is None:  # a -l list, not a directory
+                continue
+            directory = os.path.abspath(key[0])
+            if path == directory or path.startswith(
+                    directory.rstrip(os.sep) + os.sep):
+                self._sourceCache.pop(key, None)
+
+    def collect_images(self):
+        """list, then filter, images from the image directory or list file"""
         # list files recursively, or only in target directory
-        extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')
-        if self._state['list']:  # grab from user-provided list
-            rawList = self.get_imagesList()
-            for line in rawList:
-                if line.endswith(extensions):
-                    self.sourceImages.append(line)
-        elif self._state['pwd']:  # do not search subdirectories
-            for file in Path(self.imageDirectory).iterdir():
-                candidate = str(file)
-                if candidate.endswith(extensions):
-                    self.sourceImages.append(candidate)
-        else:  # default case, grab from subdirectories
-            for root, dirnames, filenames in os.walk(self.imageDirectory):
-                for file in filenames:
-                    candidate = str(Path(root, file))
-                    if candidate.endswith(extensions):
-                        self.sourceImages.append(candidate)
+        with instrument.span('scan'):
+            if self._state['list']:  # grab from user-provided list
+                rawList = self.get_imagesList()
+                for line in rawList:
+                    if line.endswith(self.extensions):
+                        self.sourceImages.append(line)
+            elif self._state['pwd']:  # do not search subdirectories
+                self.sourceImages.extend(
+                    self.get_indexed_images(recursive=False))
+            else:  # default case, grab from subdirectories
+                self.sourceImages.extend(self.get_indexed_images())
 
         # check if images list is empty
         try:
@@ -96,71 +149,216 @@ class ImageCollector(State):
             sys.exit('No valid images found in "{}"'.format(
                 self.imageDirectory))
 
-        if self.modules['Pillow']:
+        # dimensions come from image headers; Pillow is only a fallback
+        with instrument.span('filter'):
             self.image_filter()
-        else:
-            print('NOTICE: Pillow not installed. Image filtering disabled.')
-
-        # prevent runaway append to images.txt during slideshow
-        if not self._state['slideshow']:
-            self.write_images_list_file()
+        if self.is_dedupe():
+            with instrument.span('dedupe'):
+                self.sourceImages = DuplicateIndex().collapse(
+                    self.sourceImages, self.get_source_key())
         return self.sourceImages
 
+    def get_indexed_images(self, recursive=True):
+        """images from the persistent library index, walking the directory
+        directly if the index cannot be used"""
+        index = ImageIndex()
+        try:
+            if self._state['rescan']:
+                index.rebuild(os.path.abspath(self.imageDirectory))
+            return index.get_images(self.imageDirectory, recursive)
+        except sqlite3.Error as error:
+            if self._state['verbose']:
+                print('NOTICE: image index unavailable ({}).'.format(error))
+            return self.walk_images(recursive)
+
+    def walk_images(self, recursive=True):
+        """list images by walking the image directory"""
+        images = []
+        if not recursive:
+            for file in Path(self.imageDirectory).iterdir():
+                candidate = str(file)
+                if candidate.endswith(self.extensions):
+                    images.append(candidate)
+        else:
+            for root, dirnames, filenames in os.walk(self.imageDirectory):
+                for file in filenames:
+                    candidate = str(Path(root, file))
+                    if candidate.endswith(self.extensions):
+                        images.append(candidate)
+        return images
+
     def get_screen_rez(self):
-        if self.modules['Tkinter']:
-            root = tk.Tk()
-            screen_width = root.winfo_screenwidth()
-            screen_height = root.winfo_screenheight()
-            return screen_width / screen_height
-        elif self._state['filter'] == 'auto':
-            print(dedent("""\
-                Automatic aspect ratio detection disabled.
-                Please install python3-tk package."""))
+        """aspect ratio of the selected, else the primary, monitor"""
+        screen = ScreenGeometry().get_screen(self._state['monitor'])
+        if screen:
+            return screen['width'] / screen['height']
+        print(dedent("""\
+            Automatic aspect ratio detection disabled.
+            Please install xrandr or python3-tk, or set RWAL_SCREEN."""))
+
+    def is_per_monitor(self):
+        """commandline --per-monitor, or Per Monitor in rwal.conf"""
+        if self._state['per_monitor']:
+            return True
+        self.read_config()
+        try:
+            return self.config.getboolean('Defaults', 'Per Monitor',
+                                          fallback=False)
+        except ValueError:
+            print('Invalid value. Check Per Monitor setting.')
+            return False
+
+    def is_dedupe(self):
+        """commandline --dedupe, or Dedupe in rwal.conf; needs Pillow"""
+        if self._state['dedupe']:
+            dedupe = True
+        else:
+            # rwal.conf is loaded by Config.set_config(), as for the filter
+            try:
+                dedupe = self.config.getboolean('Defaults', 'Dedupe',
+                                                fallback=False)
+            except ValueError:
+                print('Invalid value. Check Dedupe setting.')
+                return False
+        if dedupe and not self.modules['Pillow']:
+            print('Duplicate detection requires Pillow.')
+            return False
+        return dedupe
+
+    def select_monitor_images(self):
+        """(screen, image) for each monitor when per-monitor wallpapers are
+        on and there is more than one monitor, else an empty list. The
+        first monitor gets the selected image; the others each get a
+        distinct image matched to their aspect ratio, using the dimensions
+        already fetched by image_filter() where there are any."""
+        if not self.is_per_monitor():
+            return []
+        screens = ScreenGeometry().get_screens()
+        if len(screens) < 2:
+            return []
+        if not self.sourceImages:
+            # next, previous and skipped images are picked without a
+            # collection; the other monitors draw on the picked image's
+            # directory, as recorded in Current Directory
+            self.imageDirectory = os.path.dirname(self.selectedImage)
+            self.sourceImages = self.get_indexed_images(recursive=False)
+        dimensions = self.sourceDimensions
+        if dimensions is None or \
+                not all(image in dimensions for image in self.sourceImages):
+            dimensions = MetadataCache().get_dimensions(self.sourceImages)
+        tolerance = self.get_tolerance()
+        ratios = [screen['width'] / screen['height'] for screen in screens]
+        readable = [image for image in self.sourceImages if dimensions[image]]
+        matches = []
+        for ratio in ratios[1:]:
+            low, high = ratio * (1 - tolerance), ratio * (1 + tolerance)
+            matches.append([image for image in readable if low <=
+                            dimensions[image][0] / dimensions[image][1] <=
+                            high])
+        chosen = [self.selectedImage]
+        for matched in matches:
+            candidates = [image for image in matched if image not in chosen]
+            if not candidates:  # no unused image of this monitor's shape
+                candidates = [image for image in readable
+                              if image not in chosen] or readable
+            chosen.append(random.choice(candidates) if candidates
+                          else self.selectedImage)
+        return list(zip(screens, chosen))
+
+    def get_tolerance(self):
+        """relative aspect ratio tolerance; commandline overrides rwal.conf"""
+        if self._state['tolerance'] is not None:
+            return abs(self._state['tolerance'])
+        self.read_config()
+        try:
+            return abs(self.config.getfloat(
+                'Wallpaper Modes', 'Aspect Ratio Tolerance', fallback=0.01))
+        except ValueError:
+            print('Invalid value. Check Aspect Ratio Tolerance setting.')
+            return 0.01
+
+    def get_ratio(self, name):
+        """ratio for a filter name such as hd1080, auto, or 21:9; None when
+        auto can't be detected, False when the name is invalid"""
+        if name == 'auto':
+            return self.get_screen_rez()
+        if name in self.aspectRatios:
+            return self.aspectRatios[name]
+        width, colon, height = name.partition(':')
+        try:
+            return float(width) / float(height) if colon else False
+        except (ValueError, ZeroDivisionError):
+            return False
 
     def image_filter(self):
-        """optionally filters images by aspect ratio"""
-        # container for final filtered list
-        filtered_images = []
-        ratios = dict(sd480=4 / 3, hd1050=8 / 5, hd1080=16 / 9,
-                      dci4k=256 / 135, hd1050x2=16 / 5, hd1080x2=32 / 9,
-                      dci4kx2=512 / 135, auto=self.get_screen_rez())
+        """optionally filters images by one or more aspect ratios, within a
+        tolerance, and by minimum size"""
         # commandline overrides config file filter setting
         if self._state['filter']:
             aspect_ratio = self._state['filter']
         else:
             aspect_ratio = self.config.get(
                 'Wallpaper Modes', 'Aspect Ratio Filter', fallback='none')
-        if aspect_ratio in ratios:
-            for pic in self.sourceImages:
-                # get image's aspect ratio, then match against filter
-                try:
-                    im = Image.open(pic)
-                    x, y = im.size
-                    image_dimensions = Fraction(x, y)
-                    im_x = image_dimensions.numerator
-                    im_y = image_dimensions.denominator
-                    if im_x / im_y == ratios[aspect_ratio]:
-                        filtered_images.append(pic)
-                except IOError:  # skip on corrupt image
-                    continue
-            if not filtered_images:
-                sys.exit('No {} images found.'.format(aspect_ratio))
+        names = [name.strip() for name in aspect_ratio.split(',')]
+        if all(name in ['None', 'NONE', 'no', 'none', 'N', 'n', '']
+               for name in names):
+            names = []
+        ranges = []
+        # rwal.conf is only consulted for a tolerance when filtering by ratio
+        tolerance = self.get_tolerance() if names else 0
+        for name in names:
+            # screen geometry is only looked up when auto is requested
+            if name == 'auto' and self.is_per_monitor():
+                # keep images for every monitor; select_monitor_images()
+                # then matches them up
+                ratios = [screen['width'] / screen['height'] for screen in
+                          ScreenGeometry().get_screens()] or \
+                    [self.get_ratio(name)]
             else:
-                self.sourceImages = filtered_images
-                return self.sourceImages
-        elif aspect_ratio not in ['None', 'NONE', 'no', 'none', 'N', 'n', '']:
-            print('Invalid value. Check image filter setting.')
+                ratios = [self.get_ratio(name)]
+            for ratio in ratios:
+                if ratio is False:
+                    print('Invalid value. Check image filter setting.')
+                    return
+                if ratio is not None:
+                    ranges.append((ratio * (1 - tolerance),
+                                   ratio * (1 + tolerance)))
+        min_width = self._state['min_width'] or 0
+        min_height = self._state['min_height'] or 0
+        if not ranges:
+            if names or not (min_width or min_height):
+                return
+            ranges.append((0, float('inf')))
+        # cached dimensions; only new or modified files are opened
+        metadata = MetadataCache()
+        self.sourceDimensions = metadata.get_dimensions(self.sourceImages)
+        filtered_images = metadata.match_ratios(
+            self.sourceImages, ranges, min_width, min_height,
+            self.sourceDimensions)
+        if not filtered_images:
+            if min_width or min_height:
+                names.append('{}x{}+'.format(min_width, min_height))
+            sys.exit('No {} images found.'.format(', '.join(names)))
+        self.sourceImages = filtered_images
+        return self.sourceImages
 
     def write_images_list_file(self):
         """produce images file for next/previous across user sessions therefore
-        this file is not temporary"""
-        with open('{}/images.txt'.format(self.configDirectory), 'w',
-                  encoding='utf-8') as images_list_file:
-            for line in self.sourceImages:
-                print(line, file=images_list_file, end='\n')
+        this file is not temporary; an unchanged list is not rewritten"""
+        written = ImageList.write(Path(self.configDirectory, 'images.idx'),
+                                  self.sourceImages)
+        if self._state['verbose'] and not written:
+            print('images list unchanged.')
+
+    def export_images_list(self, filename):
+        """write the current images list as text, for use with -l"""
+        with self.get_image_list() as imagesList:
+            imagesList.export(filename)
+        print('exported {} images to {}'.format(len(imagesList), filename))
 
     def get_imagesList(self):
-        """sorted list from images.txt for next/previous"""
+        """sorted list from a text images list: a -l file, or images.txt
+        written by earlier versions"""
         try:
             if self._state['list']:
                 listSource = self._state['list']
@@ -176,25 +374,54 @@ class ImageCollector(State):
                             'directory containing images using -d.'))
         return self.imagesList
 
+    def get_image_list(self):
+        """sorted binary images list for next/previous"""
+        listFile = Path(self.configDirectory, 'images.idx')
+        try:
+            imagesList = ImageList(listFile)
+        except (OSError, ValueError):  # convert images.txt from earlier versions
+            ImageList.write(listFile, self.get_imagesList())
+            imagesList = ImageList(listFile)
+        if not len(imagesList):
+            imagesList.close()
+            sys.exit('No images in images list. Point rwal.py at a '
+                     'directory containing images using -d.')
+        return imagesList
+
+    def get_index_position(self, imagesList):
+        """position of the indexed background in imagesList, and whether it
+        is listed there; the stored position is used while it still matches,
+        otherwise the sorted list is searched"""
+        self.get_index_background()
+        position = self.bgConfig.get('Temp', 'Indexed Position', fallback='')
+        if position.isdigit() and int(position) < len(imagesList) and \
+                imagesList[int(position)] == self.indexedBG:
+            return int(position), True
+        position = imagesList.bisect(self.indexedBG)
+        listed = position < len(imagesList) and \
+            imagesList[position] == self.indexedBG
+        return position, listed
+
     def index_background(self):
         """allows next/previous to move passed corrupted images"""
-        self.read_bgConfig()
-        self.bgConfig.set('Temp', 'Indexed Background', self.selectedImage)
-        with open(str(self.bgFile), 'w') as configfile:
-            self.bgConfig.write(configfile)
+        self.set_bgConfig('Indexed Background', self.selectedImage)
+        # position in images.idx, when known, so the next step is a seek
+        self.set_bgConfig('Indexed Position',
+                          '' if self.selectedPosition is None
+                          else str(self.selectedPosition))
 
     def record_background(self):
         """records applied background"""
-        self.read_bgConfig()
         bg_dir = os.path.dirname(self.selectedImage)
-        self.bgConfig.set('Temp', 'Current Directory', bg_dir)
-        self.bgConfig.set('Temp', 'Current Background', self.selectedImage)
-        with open(str(self.bgFile), 'w') as configfile:
-            self.bgConfig.write(configfile)
+        self.set_bgConfig('Current Directory', bg_dir)
+        self.set_bgConfig('Current Background', self.selectedImage)
+        ShowHistory().record(self.selectedImage)
 
     def skip_image(self):
-        selector = ImageSelector()
+        # index before a new selector resets the shared selection, so that
+        # next/previous step on from the skipped file's stored position
         self.index_background()
+        selector = ImageSelector()
         print('rwal skipped:\n{}\nIt is a corrupted or missing file.\
               '.format(self.get_index_background()))
         if self._state['image_action'] == 'next':
@@ -212,21 +439,28 @@ class ImageCollector(State):
             self.selectedImage = selector.get_pic(action)
 
         # skip corrupted and missing files
-        try:
-            if imghdr.what(self.selectedImage) in self.fileTypes:
-                self.index_background()
-            else:
+        with instrument.span('validate'):
+            try:
+                if self.get_image_type(self.selectedImage) in self.fileTypes:
+                    self.index_background()
+                else:
+                    self.skip_image()
+            except FileNotFoundError:
+                self.skip_image()
+            except TypeError:
                 self.skip_image()
-        except FileNotFoundError:
-            self.skip_image()
-        except TypeError:
-            self.skip_image()
 
         # used with get_record_background() and edit_background()
         self.record_background()
 
         return self.selectedImage
 
+    def get_image_type(self, image):
+        """image type read from the file header, None if not an image"""
+        probed = probe_image(image)
+        if probed:
+            return probed[0]
+
     def get_index_background(self):
         """"retrieves index for next/previous functions"""
         self.read_bgConfig()
@@ -240,9 +474,11 @@ class ImageCollector(State):
         # if in windows, don't use xclip; if in MacOS us pbcopy
         if 'APPDATA' not in os.environ:
             if self.depends['xclip'][1]:
+                instrument.count('subprocess')
                 subprocess.run('echo -n "{}" | \
                      xclip -selection clipboard'.format(applied_bg), shell=True)
         elif 'Apple_PubSub_Socket_Render' in os.environ:
+            instrument.count('subprocess')
             subprocess.run(
                 'echo -n {} | pbcopy'.format(applied_bg), shell=True)
         return applied_bg
@@ -251,6 +487,7 @@ class ImageCollector(State):
         self.read_config()
         applied_bg = self.get_record_background()
         edit_bg = self.config.get('Defaults', 'Default Background Editor')
+        instrument.count('subprocess')
         return subprocess.run('{} \'{}\''.format(edit_bg, applied_bg),
                                shell=True)
 
@@ -266,6 +503,13 @@ class ImageSelector(State):
     def select_random_image(self):
         """default image value"""
         self.images.get_source_images()
+        mode = self.get_selection_mode()
+        if mode == 'weighted':
+            return ShowHistory().choose(self.images.sourceImages,
+                                        self.images.get_source_key())
+        elif mode == 'shuffle':
+            return ShuffleBag().choose(self.images.sourceImages,
+                                       self.images.get_source_key())
         random_image = random.choice(self.images.sourceImages)
         return random_image
 
@@ -280,7 +524,7 @@ class ImageSelector(State):
         self.images.imageDirectory = os.path.dirname(self._state['directory'])
         commandline_image = self._state['directory']
         try:  # validate
-            if imghdr.what(commandline_image) in self.fileTypes:
+            if self.images.get_image_type(commandline_image) in self.fileTypes:
                 self.images.get_source_images()
                 return commandline_image
             else:
@@ -291,39 +535,36 @@ class ImageSelector(State):
             return sys.exit('No such file!')
 
     def select_next_image(self):
-        """step to next image in imagesList"""
+        """step to next image in the images list"""
         # target of self._state when assigned 'next'
-        self.images.get_imagesList()
-        self.images.get_index_background()
-        # retrieve index of current background in image list
-        image_index = self.images.imagesList.index(self.images.indexedBG)
-        try:
-            if self.images.indexedBG in self.images.imagesList:
-                next_image = self.images.imagesList[image_index + 1]
-        except IndexError:
-            next_image = self.images.imagesList[0]
-            print('Reached end of list: applying first image in list!')
-        if self._state['verbose']:
-            print('Background {} in a list of {} applied.'.format(
-                image_index + 1, len(self.images.imagesList)))
+        with self.images.get_image_list() as imagesList:
+            position, listed = self.images.get_index_position(imagesList)
+            # an unlisted background falls between its neighbours
+            step = position + 1 if listed else position
+            if step >= len(imagesList):
+                step = 0
+                print('Reached end of list: applying first image in list!')
+            next_image = imagesList[step]
+            if self._state['verbose']:
+                print('Background {} in a list of {} applied.'.format(
+                    step + 1, len(imagesList)))
+        self.images.selectedPosition = step
         return next_image
 
     def select_previous_image(self):
-        """step to previous image in imagesList"""
+        """step to previous image in the images list"""
         # target of self._state when assigned 'previous'
-        self.images.get_imagesList()
-        self.images.get_index_background()
-        # retrieve index of current background in image list
-        image_index = self.images.imagesList.index(self.images.indexedBG)
-        try:
-            if self.images.indexedBG in self.images.imagesList:
-                last_image = self.images.imagesList[image_index - 1]
-        except IndexError:
-            last_image = self.images.imagesList[-1]
-            print('Reached beginning of list: applying last image in list!')
-        if self._state['verbose']:
-            print('Background {} in a list of {} applied.'.format(
-                image_index - 1, len(self.images.imagesList)))
+        with self.images.get_image_list() as imagesList:
+            position, listed = self.images.get_index_position(imagesList)
+            step = position - 1
+            if step < 0:
+                step = len(imagesList) - 1
+                print('Reached beginning of list: applying last image in list!')
+            last_image = imagesList[step]
+            if self._state['verbose']:
+                print('Background {} in a list of {} applied.'.format(
+                    step + 1, len(imagesList)))
+        self.images.selectedPosition = step
         return last_image
 
     def get_pic(self, action=None):
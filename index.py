@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Module for keeping a persistent index of the image library, so that rwal
+does not have to walk every directory on each invocation"""
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+import instrument
+from state import State
+
+
+class ImageIndex(State):
+    """sqlite index of image paths, sizes and mtimes, refreshed by rescanning
+    only the directories whose mtime has changed since the last run"""
+
+    def __init__(self):
+        super(ImageIndex, self).__init__()
+        # one index and connection per process, shared by every instance
+        if 'indexConnection' not in self._state:
+            self.indexFile = Path(self.configDirectory, 'library.db')
+            self.indexConnection = None
+            # serializes index access between requests and watcher threads
+            self.indexLock = threading.RLock()
+            # directories kept current by a watcher, which need no refresh
+            self.watchedRoots = set()
+
+    def open_index(self):
+        """connect to the index database, creating its tables if absent"""
+        if self.indexConnection is None:
+            os.makedirs(str(Path(self.indexFile).parent), exist_ok=True)
+            db = sqlite3.connect(str(self.indexFile), check_same_thread=False)
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER);
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY, dir TEXT, size INTEGER,
+                    mtime INTEGER);
+                CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+                CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+                """)
+            self.indexConnection = db
+        return self.indexConnection
+
+    def close_index(self):
+        if self.indexConnection is not None:
+            self.indexConnection.close()
+            self.indexConnection = None
+
+    @staticmethod
+    def subtree(column):
+        """sql clause matching a directory and everything beneath it; a
+        range over the prefix, so that the column's index is used"""
+        return '({0} = ? OR ({0} >= ? AND {0} < ?))'.format(column)
+
+    @staticmethod
+    def subtree_args(directory):
+        prefix = directory.rstrip(os.sep) + os.sep
+        # paths beneath the prefix sort before it followed by the highest
+        # code point
+        return directory, prefix, prefix + chr(0x10FFFF)
+
+    def scan_directory(self, task):
+        """stat a directory, listing its images and subdirectories only if its
+        mtime differs from the stored one; runs in a worker thread"""
+        directory, parent, stored = task
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            instrument.count('stat')
+        except OSError:  # directory removed
+            return directory, parent, None, None, None
+        if mtime == stored:
+            return directory, parent, mtime, None, None
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        # symlinked directories are left out, as by
+                        # os.walk(), so a link to an ancestor can't loop
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.endswith(self.extensions):
+                            st = entry.stat()
+                            files.append((entry.path, directory, st.st_size,
+                                          st.st_mtime_ns))
+                    except OSError:  # vanished or unreadable entry
+                        continue
+        except OSError:
+            return directory, parent, None, None, None
+        instrument.count('stat', len(files))
+        return directory, parent, mtime, files, subdirs
+
+    def store_directory(self, db, directory, parent, mtime, files, subdirs):
+        """replace the stored entries of one scanned directory"""
+        # a directory modified within the timestamp granularity of this scan
+        # could change again unnoticed, so force a rescan next time
+        if time.time_ns() - mtime < 2 * 10 ** 9:
+            mtime = -1
+        db.execute('DELETE FROM files WHERE dir = ?', (directory,))
+        db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                       files)
+        known = {row[0] for row in db.execute(
+            'SELECT path FROM dirs WHERE parent = ?', (directory,))}
+        for gone in known.difference(subdirs):
+            self.forget(db, gone)
+        # placeholders keep subdirectories discoverable after a shallow scan
+        db.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)',
+                       [(sub, directory) for sub in subdirs])
+        db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                   (directory, parent, mtime))
+
+    def forget(self, db, directory):
+        """drop a directory and everything beneath it from the index"""
+        args = self.subtree_args(directory)
+        db.execute('DELETE FROM dirs WHERE ' + self.subtree('path'), args)
+        db.execute('DELETE FROM files WHERE ' + self.subtree('dir'), args)
+
+    def refresh(self, directory, recursive=True):
+        """rescan only directories whose mtime differs from the index; each
+        level of the tree is stat'ed and listed concurrently. Returns the
+        directories that changed."""
+        db = self.open_index()
+        level = [(directory, os.path.dirname(directory))]
+        changed = []
+        with self.indexLock, db, self.worker_pool() as pool:
+            while level:
+                tasks = []
+                for current, parent in level:
+                    row = db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                     (current,)).fetchone()
+                    tasks.append((current, parent, row and row[0]))
+                level = []
+                # map preserves task order, keeping the index deterministic
+                for current, parent, mtime, files, subdirs in pool.map(
+                        self.scan_directory, tasks):
+                    if mtime is None:
+                        self.forget(db, current)
+                        changed.append(current)
+                        continue
+                    if files is None:  # unchanged since the last scan
+                        subdirs = [row[0] for row in db.execute(
+                            'SELECT path FROM dirs WHERE parent = ?',
+                            (current,))]
+                    else:
+                        self.store_directory(db, current, parent, mtime,
+                                             files, subdirs)
+                        changed.append(current)
+                    if recursive:
+                        level.extend((sub, current) for sub in subdirs)
+        return changed
+
+    def rebuild(self, directory):
+        """discard the indexed tree, then rescan every file beneath it"""
+        db = self.open_index()
+        with self.indexLock, db:
+            self.forget(db, directory)
+        return self.refresh(directory)
+
+    def add_file(self, path):
+        """index one new or modified image, as reported by a watcher"""
+        try:
+            st = os.stat(path)
+            instrument.count('stat')
+        except OSError:
+            return self.remove_file(path)
+        db = self.open_index()
+        with self.indexLock, db:
+            db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                       (path, os.path.dirname(path), st.st_size,
+                        st.st_mtime_ns))
+
+    def remove_file(self, path):
+        db = self.open_index()
+        with self.indexLock, db:
+            db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def is_watched(self, directory):
+        return any(directory == root or directory.startswith(
+            root.rstrip(os.sep) + os.sep) for root in self.watchedRoots)
+
+    def get_images(self, directory, recursive=True):
+        """refresh the index, then return indexed images in path order"""
+        directory = os.path.abspath(directory)
+        if not self.is_watched(directory):
+            self.refresh(directory, recursive)
+        if recursive:
+            query = 'SELECT path FROM files WHERE {} ORDER BY path'.format(
+                self.subtree('dir'))
+            args = self.subtree_args(directory)
+        else:
+            query = 'SELECT path FROM files WHERE dir = ? ORDER BY path'
+            args = (directory,)
+        with self.indexLock:
+            return [row[0] for row in self.open_index().execute(query, args)]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Module for lightweight instrumentation: timed spans around rwal's stages
+and counters of the work done in them, reported by --stats and appended to
+the Stats Log. Nothing is recorded until start(), so uninstrumented runs only
+pay for a flag check."""
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import functools
+import contextlib
+
+# counters in report order, with their labels
+COUNTERS = (('stat', 'files stat\'ed'), ('open', 'images opened'),
+            ('bytes_read', 'bytes read'), ('subprocess', 'subprocesses'),
+            ('config_read', 'config reads'), ('config_write', 'config writes'))
+# the Stats Log is rolled over to FILE.1 once it reaches this many bytes
+LOG_SIZE = 1024 * 1024
+
+enabled = False
+# (outer span, ..., span) mapped to [times entered, total seconds], in the
+# order the spans were first entered
+spans = {}
+counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+_started = None
+_bytesStart = None
+
+
+def read_bytes():
+    """bytes this process has read through system calls, where the kernel
+    reports it; None elsewhere"""
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+
+
+def start():
+    """discard anything recorded, then record from now on"""
+    global enabled, _started, _bytesStart
+    with _lock:
+        spans.clear()
+        counters.clear()
+        _local.stack = ()
+        _bytesStart = read_bytes()
+        _started = time.perf_counter()
+        enabled = True
+
+
+def finish(argv=None):
+    """stop recording and return the report on the command argv, by default
+    this process's"""
+    global enabled
+    with _lock:
+        enabled = False
+        elapsed = time.perf_counter() - _started
+        total = read_bytes()
+        if total is not None and _bytesStart is not None:
+            counters['bytes_read'] = total - _bytesStart
+        return dict(
+            time=round(time.time(), 3), host=platform.node(), pid=os.getpid(),
+            argv=list(sys.argv[1:] if argv is None else argv),
+            ms=round(elapsed * 1000, 3),
+            spans=[dict(name='/'.join(path), count=count,
+                        ms=round(seconds * 1000, 3))
+                   for path, (count, seconds) in spans.items()],
+            # bytes read is left out where the kernel doesn't report it
+            counters=dict((name, counters.get(name, 0))
+                          for name, label in COUNTERS
+                          if name != 'bytes_read' or name in counters))
+
+
+def count(name, amount=1):
+    if enabled:
+        with _lock:
+            counters[name] = counters.get(name, 0) + amount
+
+
+@contextlib.contextmanager
+def span(name):
+    """time the enclosed block under name, nested within the spans this
+    thread is already in"""
+    if not enabled:
+        yield
+        return
+    parent = getattr(_local, 'stack', ())
+    path = parent + (name,)
+    with _lock:
+        spans.setdefault(path, [0, 0.0])
+    _local.stack = path
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - began
+        _local.stack = parent
+        with _lock:
+            entry = spans.setdefault(path, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+
+def timed(name):
+    """decorator timing each call of a function as a span"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def format_size(size):
+    if size < 1024:
+        return '{} B'.format(size)
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def format_report(report, style='human'):
+    """the report as indented text, or as JSON"""
+    if style == 'json':
+        return json.dumps(report)
+    lines = ['rwal stats: {:.1f} ms'.format(report['ms'])]
+    for entry in report['spans']:
+        path = entry['name'].split('/')
+        label = '  ' * len(path) + path[-1]
+        if entry['count'] > 1:
+            label += ' x{}'.format(entry['count'])
+        lines.append('{:<36}{:>10.1f} ms'.format(label, entry['ms']))
+    for name, label in COUNTERS:
+        if name not in report['counters']:
+            continue
+        value = report['counters'][name]
+        if name == 'bytes_read':
+            value = format_size(value)
+        lines.append('  {:<34}{:>13}'.format(label, value))
+    return '\n'.join(lines)
+
+
+def append_log(filename, report):
+    """append the report to a JSON-lines log, rolling a full log over to
+    FILE.1, which replaces the previous one"""
+    filename = os.path.expanduser(filename)
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if os.path.getsize(filename) >= LOG_SIZE:
+            os.replace(filename, filename + '.1')
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        print('rwal could not roll over stats log: {}'.format(error),
+              file=sys.stderr)
+    try:
+        with open(filename, 'a') as log:
+            log.write(json.dumps(report) + '\n')
+    except OSError as error:
+        print('rwal could not write stats log: {}'.format(error),
+              file=sys.stderr)
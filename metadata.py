@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Module for caching image metadata between runs, so that filters only have
+to open new or modified files"""
+import os
+import instrument
+from state import State
+from index import ImageIndex
+from headers import probe_image
+
+
+class MetadataCache(State):
+    """image dimensions stored in the library index, keyed by path, size and
+    mtime so that a changed file is probed again automatically"""
+
+    # sqlite limits the number of bound parameters per statement
+    chunkSize = 500
+
+    def __init__(self):
+        super(MetadataCache, self).__init__()
+
+    def open_cache(self):
+        db = ImageIndex().open_index()
+        db.execute("""CREATE TABLE IF NOT EXISTS dimensions (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+            type TEXT, width INTEGER, height INTEGER, ratio REAL)""")
+        columns = [row[1] for row in db.execute(
+            'PRAGMA table_info(dimensions)')]
+        if 'ratio' not in columns:  # cache written by an earlier version
+            with db:
+                db.execute('ALTER TABLE dimensions ADD COLUMN ratio REAL')
+                db.execute('UPDATE dimensions SET ratio = '
+                           'CAST(width AS REAL) / height WHERE height > 0')
+        db.execute('CREATE INDEX IF NOT EXISTS dimensions_ratio '
+                   'ON dimensions (ratio)')
+        return db
+
+    def chunks(self, paths):
+        for start in range(0, len(paths), self.chunkSize):
+            yield paths[start:start + self.chunkSize]
+
+    def select(self, db, query, paths):
+        """run an IN query over paths in chunks, yielding rows"""
+        for chunk in self.chunks(paths):
+            marks = ','.join('?' * len(chunk))
+            yield from db.execute(query.format(marks), chunk)
+
+    def stat_files(self, paths):
+        """(size, mtime) of each path, or None if it is missing; runs in a
+        worker thread"""
+        stats = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def get_stats(self, db, paths):
+        """(size, mtime) per path, or None if it is missing. Every file is
+        stat'd, since the library index only sees changes to a directory's
+        entries, not an image edited in place; index rows found out of date
+        are corrected."""
+        # in chunks, so a pool doesn't cost a task per file
+        with self.worker_pool() as pool:
+            stats = dict(zip(paths, (stat for chunk in pool.map(
+                self.stat_files, self.chunks(paths)) for stat in chunk)))
+        instrument.count('stat', len(paths))
+        changed = [stats[path] + (path,) for path, size, mtime in self.select(
+            db, 'SELECT path, size, mtime FROM files WHERE path IN ({})',
+            paths) if stats[path] and stats[path] != (size, mtime)]
+        if changed:
+            with db:
+                db.executemany('UPDATE files SET size = ?, mtime = ? '
+                               'WHERE path = ?', changed)
+        return stats
+
+    def probe(self, path):
+        """read type and dimensions from the file header, falling back to
+        Pillow; (None, 0, 0) marks a bad image"""
+        try:
+            return probe_image(path) or (None, 0, 0)
+        except OSError:
+            return None, 0, 0
+
+    def get_dimensions(self, paths):
+        """map each path to (width, height), or None if it is unreadable"""
+        paths = list(paths)
+        with ImageIndex().indexLock:
+            return self.lookup_dimensions(paths)
+
+    def lookup_dimensions(self, paths):
+        db = self.open_cache()
+        stats = self.get_stats(db, paths)
+        dimensions, stale = {}, []
+        for path, size, mtime, kind, width, height in self.select(
+                db, 'SELECT path, size, mtime, type, width, height '
+                    'FROM dimensions WHERE path IN ({})', paths):
+            if stats.get(path) == (size, mtime):
+                dimensions[path] = (width, height)
+        for path in paths:
+            if path in dimensions:
+                continue
+            if stats[path] is None:  # missing file
+                dimensions[path] = None
+            else:
+                stale.append(path)
+        if stale:
+            # headers are probed concurrently; latency bound on network shares
+            with self.worker_pool() as pool:
+                probes = list(pool.map(self.probe, stale))
+            rows = []
+            for path, probed in zip(stale, probes):
+                kind, width, height = probed
+                dimensions[path] = (width, height)
+                ratio = width / height if width and height else None
+                rows.append((path,) + stats[path] + probed + (ratio,))
+            with db:
+                db.executemany('INSERT OR REPLACE INTO dimensions '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return {path: size if size and all(size) else None
+                for path, size in dimensions.items()}
+
+    def match_ratios(self, paths, ranges, min_width=0, min_height=0,
+                     dimensions=None):
+        """paths, in their given order, whose aspect ratio lies within any
+        of the (low, high) ranges and that meet the minimum size; stale
+        entries are probed first, unless their dimensions were just
+        fetched"""
+        return self.match_each(paths, [ranges], min_width, min_height,
+                               dimensions)[0]
+
+    def match_each(self, paths, range_lists, min_width=0, min_height=0,
+                   dimensions=None):
+        """match_ratios() for several lists of ranges, such as one per
+        monitor, with a single pass over the files. The candidates'
+        dimensions are in hand once looked up, so they are matched in
+        memory rather than by querying the whole cache, which can hold far
+        more of the library than the source."""
+        paths = list(paths)
+        if dimensions is None:
+            dimensions = self.get_dimensions(paths)
+        sized = []
+        for path in paths:
+            size = dimensions[path]
+            if size and size[0] >= min_width and size[1] >= min_height:
+                sized.append((path, size[0] / size[1]))
+        return [[path for path, ratio in sized
+                 if any(low <= ratio <= high for low, high in ranges)]
+                for ranges in range_lists]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Module for finding near-duplicate images, such as resized copies and
+re-encodes, by perceptual hash; the hashes are cached in library.db beside the
+image dimensions and searched with a BK-tree"""
+import math
+import statistics
+import instrument
+from state import State
+from index import ImageIndex
+from metadata import MetadataCache
+
+# images are reduced to SIZE x SIZE greys; the hashes keep the lowest
+# BITS x BITS frequencies, or means
+SIZE = 32
+BITS = 8
+# the rows of a DCT-II matrix for the kept frequencies
+DCT = [[math.cos(math.pi * (2 * n + 1) * k / (2 * SIZE)) for n in range(SIZE)]
+       for k in range(BITS)]
+
+
+def hamming(first, second):
+    return bin(first ^ second).count('1')
+
+
+def to_bits(values, threshold):
+    """64-bit hash with a bit set, most significant first, for each value
+    above threshold"""
+    bits = 0
+    for value in values:
+        bits = (bits << 1) | (value > threshold)
+    return bits
+
+
+def dct_low(pixels, numpy=None):
+    """lowest BITS x BITS frequencies of a SIZE x SIZE block of pixels,
+    row-major; C . X . C^T, vectorized when NumPy is available"""
+    if numpy is not None:
+        matrix = numpy.array(DCT)
+        block = numpy.asarray(pixels, dtype=numpy.float64).reshape(SIZE, SIZE)
+        return (matrix @ block @ matrix.T).ravel().tolist()
+    rows = [pixels[start:start + SIZE]
+            for start in range(0, SIZE * SIZE, SIZE)]
+    # each row to its low frequencies, then each resulting column
+    across = [[sum(x * c for x, c in zip(row, basis)) for basis in DCT]
+              for row in rows]
+    return [sum(basis[r] * across[r][v] for r in range(SIZE))
+            for basis in DCT for v in range(BITS)]
+
+
+def hash_picture(picture, numpy=None):
+    """(average hash, DCT hash) of a greyscale SIZE x SIZE Pillow image"""
+    from PIL import Image
+    means = list(picture.resize((BITS, BITS), Image.BOX).tobytes())
+    if numpy is not None:
+        pixels = numpy.asarray(picture, dtype=numpy.float64)
+    else:
+        pixels = list(picture.tobytes())
+    low = dct_low(pixels, numpy)
+    # as in pHash, the DC term sets the mean brightness so is left out of
+    # the median
+    return to_bits(means, sum(means) / len(means)), \
+        to_bits(low, statistics.median(low[1:]))
+
+
+class BKTree:
+    """metric tree over Hamming distance; each node is [hash, items,
+    {distance: child}], and a search only descends into children whose
+    distance could hold a match"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """items whose hash is within radius of value"""
+        found = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend(node[1])
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    pending.append(child)
+        return found
+
+
+class DuplicateIndex(State):
+    """perceptual hashes keyed by path, size and mtime like the cached
+    dimensions, so only new or modified files are decoded; images whose DCT
+    and average hashes both lie within the threshold are duplicates"""
+
+    def __init__(self):
+        super(DuplicateIndex, self).__init__()
+        # BK-tree of the most recent source, kept between collections
+        if 'duplicateTree' not in self._state:
+            self.duplicateSource = None
+            self.duplicateTree = None
+            self.duplicateHashes = None
+
+    def open_hashes(self):
+        db = ImageIndex().open_index()
+        db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+            ahash TEXT, phash TEXT)""")
+        return db
+
+    def get_threshold(self):
+        """differing bits, of 64, still counted as the same picture"""
+        self.read_config()
+        try:
+            threshold = self.config.getint('Defaults', 'Duplicate Threshold',
+                                           fallback=6)
+        except ValueError:
+            print('Invalid value. Check Duplicate Threshold setting.')
+            threshold = 6
+        return max(0, threshold)
+
+    def hash_file(self, path):
+        """(average hash, DCT hash), decoded at a reduced JPEG scale, or
+        (None, None) if the file can't be decoded; runs in a worker thread"""
+        from PIL import Image, ImageOps
+        numpy = None
+        if self.modules['NumPy']:
+            import numpy
+        instrument.count('open')
+        try:
+            with Image.open(path) as source:
+                source.draft('L', (SIZE * 2, SIZE * 2))
+                picture = ImageOps.exif_transpose(source).convert('L')
+            return hash_picture(picture.resize((SIZE, SIZE), Image.LANCZOS),
+                                numpy)
+        except (OSError, SyntaxError, ValueError):
+            return None, None
+
+    def get_hashes(self, paths):
+        """map each path to its (average hash, DCT hash), or None if it is
+        missing or can't be decoded"""
+        paths = list(paths)
+        metadata = MetadataCache()
+        with ImageIndex().indexLock:
+            db = self.open_hashes()
+            stats = metadata.get_stats(db, paths)
+            hashes, stale = {}, []
+            for path, size, mtime, ahash, phash in metadata.select(
+                    db, 'SELECT path, size, mtime, ahash, phash '
+                        'FROM hashes WHERE path IN ({})', paths):
+                if stats.get(path) == (size, mtime):
+                    hashes[path] = (int(ahash, 16), int(phash, 16)) \
+                        if ahash else None
+            for path in paths:
+                if path in hashes:
+                    continue
+                if stats[path] is None:  # missing file
+                    hashes[path] = None
+                else:
+                    stale.append(path)
+            if stale:
+                if self._state['verbose']:
+                    print('hashing {} images...'.format(len(stale)))
+                # Pillow releases the GIL while decoding
+                with self.worker_pool() as pool:
+                    computed = list(pool.map(self.hash_file, stale))
+                rows = []
+                for path, (ahash, phash) in zip(stale, computed):
+                    hashes[path] = None if ahash is None else (ahash, phash)
+                    # hex, since a 64-bit hash can overflow sqlite's INTEGER
+                    rows.append((path,) + stats[path] + (
+                        (None, None) if ahash is None else
+                        ('{:016x}'.format(ahash), '{:016x}'.format(phash))))
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO hashes '
+                                   'VALUES (?, ?, ?, ?, ?)', rows)
+        return hashes
+
+    def get_tree(self, hashes, source=None):
+        """BK-tree over the DCT hashes. The tree of a source is kept and
+        only extended with new or changed images; entries of removed or
+        changed ones stay until it grows to twice the source's size, so
+        matches are checked against the current hashes."""
+        if source is None or source != self.duplicateSource or \
+                len(self.duplicateHashes) > 2 * len(hashes):
+            self.duplicateSource = source
+            self.duplicateTree, self.duplicateHashes = BKTree(), {}
+        for path, value in hashes.items():
+            if value and self.duplicateHashes.get(path) != value:
+                self.duplicateTree.add(value[1], path)
+                self.duplicateHashes[path] = value
+        return self.duplicateTree
+
+    def find_duplicates(self, paths, source=None):
+        """clusters of near-duplicate paths, each led by its largest image;
+        paths without a match are left out. A source, such as the key of
+        ImageCollector.get_source_images(), keeps its BK-tree for the next
+        call."""
+        paths = list(paths)
+        hashes = self.get_hashes(paths)
+        dimensions = MetadataCache().get_dimensions(paths)
+        threshold = self.get_threshold()
+
+        def pixels(path):
+            return -(dimensions[path][0] * dimensions[path][1]) \
+                if dimensions.get(path) else 0
+
+        ranked = sorted((path for path in paths if hashes[path]),
+                        key=lambda path: (pixels(path), path))
+        rank = {path: position for position, path in enumerate(ranked)}
+        tree = self.get_tree({path: hashes[path] for path in ranked}, source)
+        clustered, clusters = set(), []
+        for path in ranked:
+            if path in clustered:
+                continue
+            ahash, phash = hashes[path]
+            # the tree may hold removed images and earlier hashes
+            members = sorted(
+                {match for match in tree.search(phash, threshold)
+                 if match in rank and match not in clustered and
+                 hamming(hashes[match][1], phash) <= threshold and
+                 hamming(hashes[match][0], ahash) <= threshold},
+                key=rank.get)
+            clustered.update(members)
+            if len(members) > 1:
+                clusters.append(members)
+        return clusters
+
+    def collapse(self, paths, source=None):
+        """paths, in their given order, with each cluster of near-duplicates
+        reduced to its largest image"""
+        clusters = self.find_duplicates(paths, source)
+        dropped = {path for members in clusters for path in members[1:]}
+        if self._state['verbose'] and clusters:
+            print('Collapsed {} near-duplicate images into {} clusters.'
+                  .format(len(dropped) + len(clusters), len(clusters)))
+        return [path for path in paths if path not in dropped]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Module for rendering wallpapers at the display's resolution ahead of
+applying them, so the desktop never has to decode and scale a huge file"""
+import os
+from pathlib import Path
+import instrument
+from state import State
+from screen import ScreenGeometry
+
+# each desktop's wallpaper modes as the placement rendered for them; modes
+# missing here, such as tiled and spanned, are applied unrendered
+PLACEMENTS = {
+    # GNOME3, Cinnamon and MATE
+    'zoom': 'fill', 'scaled': 'fit', 'centered': 'center',
+    'stretched': 'stretch',
+    # Xfce
+    '0': 'fit', '1': 'center', '3': 'stretch', '4': 'fit', '5': 'fill',
+    # LXDE
+    'center': 'center', 'fit': 'fit', 'stretch': 'stretch',
+    # feh
+    '--bg-max': 'fit', '--bg-scale': 'stretch', '--bg-fill': 'fill',
+    '--bg-center': 'center',
+}
+
+
+class RenderCache(State):
+    """wallpapers pre-scaled to the screen, kept in a size-bounded cache in
+    $XDG_CACHE_HOME/rwal/render; the least recently applied are evicted. The
+    cache stays out of configDirectory, which KDE's slideshow scans."""
+
+    def __init__(self):
+        super(RenderCache, self).__init__()
+        cache = os.environ.get('XDG_CACHE_HOME') or \
+            Path(self._state['home'], '.cache')
+        self.renderDirectory = Path(cache, 'rwal', 'render')
+
+    def is_enabled(self):
+        """commandline --render, or Render Cache in rwal.conf"""
+        if self._state['render_cache']:
+            return True
+        self.read_config()
+        try:
+            return self.config.getboolean('Defaults', 'Render Cache',
+                                          fallback=False)
+        except ValueError:
+            print('Invalid value. Check Render Cache setting.')
+            return False
+
+    def get_cache_size(self):
+        """cache limit in bytes, set in megabytes in rwal.conf"""
+        self.read_config()
+        try:
+            size = self.config.getint('Defaults', 'Render Cache Size',
+                                      fallback=256)
+        except ValueError:
+            print('Invalid value. Check Render Cache Size setting.')
+            size = 256
+        return max(0, size) * 1024 * 1024
+
+    def cache_path(self, image, width, height, placement):
+        """cache file named for the source file's identity and the target"""
+        import hashlib
+        st = os.stat(image)
+        instrument.count('stat')
+        key = hashlib.blake2b(repr((os.path.abspath(image), st.st_size,
+                                    st.st_mtime_ns, width, height,
+                                    placement)).encode('utf-8',
+                                                       'surrogateescape'),
+                              digest_size=16).hexdigest()
+        return Path(self.renderDirectory, key)
+
+    def render(self, image, mode, screen=None):
+        """path of image rendered for the screen, by default the selected
+        monitor, and wallpaper mode; image itself when it can't or needn't
+        be rendered, as when the desktop places it itself (mode None)"""
+        placement = PLACEMENTS.get(mode)
+        if screen is None:
+            screen = ScreenGeometry().get_screen(self._state['monitor'])
+        if placement is None or not screen or not self.modules['Pillow']:
+            return image
+        width, height = screen['width'], screen['height']
+        try:
+            cached = self.cache_path(image, width, height, placement)
+            hit = self.find_cached(cached)
+            if hit:
+                return hit
+            rendered = self.render_file(image, cached, width, height,
+                                        placement)
+        except (OSError, ValueError) as error:
+            if self._state['verbose']:
+                print('rwal could not render {}: {}'.format(image, error))
+            return image
+        if rendered is None:
+            return image
+        self.evict(rendered)
+        return rendered
+
+    def find_cached(self, cached):
+        for suffix in ('.jpg', '.png'):
+            hit = cached.with_suffix(suffix)
+            if hit.exists():
+                # mtime orders the cache for eviction
+                os.utime(str(hit))
+                return str(hit)
+
+    def open_scaled(self, image, width, height):
+        """(picture, alpha) decoded at a reduced JPEG scale that still covers
+        width x height, whichever way the camera was held"""
+        from PIL import Image, ImageOps
+        instrument.count('open')
+        with Image.open(image) as source:
+            side = max(width, height)
+            source.draft('RGB', (side, side))
+            picture = ImageOps.exif_transpose(source)
+            alpha = 'A' in picture.mode or 'transparency' in picture.info
+            return picture.convert('RGBA' if alpha else 'RGB'), alpha
+
+    def render_file(self, image, cached, width, height, placement):
+        """scale and crop image into the cache; None if it is already no
+        larger than the screen"""
+        from PIL import Image, ImageOps
+        instrument.count('open')
+        with Image.open(image) as source:
+            if source.width <= width and source.height <= height:
+                return None
+        picture, alpha = self.open_scaled(image, width, height)
+        if placement == 'fill':
+            picture = ImageOps.fit(picture, (width, height), Image.LANCZOS)
+        elif placement == 'stretch':
+            picture = picture.resize((width, height), Image.LANCZOS)
+        elif placement == 'center':
+            left = max(0, (picture.width - width) // 2)
+            top = max(0, (picture.height - height) // 2)
+            picture = picture.crop((left, top, left + min(width, picture.width),
+                                    top + min(height, picture.height)))
+        else:
+            picture.thumbnail((width, height), Image.LANCZOS)
+        return self.save(picture, cached, alpha)
+
+    def save(self, picture, cached, alpha=False):
+        """write picture into the cache atomically, returning its path"""
+        import tempfile
+        suffix = '.png' if alpha else '.jpg'
+        os.makedirs(str(self.renderDirectory), exist_ok=True)
+        descriptor, staging = tempfile.mkstemp(dir=str(self.renderDirectory),
+                                               prefix='.render.', suffix=suffix)
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                if alpha:
+                    picture.save(output, 'PNG')
+                else:
+                    picture.save(output, 'JPEG', quality=92)
+            target = str(cached.with_suffix(suffix))
+            os.replace(staging, target)
+        except BaseException:
+            os.remove(staging)
+            raise
+        return target
+
+    def fill_screen(self, output):
+        from PIL import Image, ImageOps
+        screen, image = output
+        size = (screen['width'], screen['height'])
+        picture = self.open_scaled(image, *size)[0].convert('RGB')
+        return ImageOps.fit(picture, size, Image.LANCZOS)
+
+    def compose(self, outputs):
+        """one image spanning every monitor, each (screen, image) pair
+        filling its screen's area; for desktops that take a single image"""
+        from PIL import Image
+        import hashlib
+        key = hashlib.blake2b(digest_size=16)
+        for screen, image in outputs:
+            key.update(str(self.cache_path(image, screen['width'],
+                                           screen['height'], 'span')).encode())
+            key.update(repr(sorted(screen.items())).encode())
+        cached = Path(self.renderDirectory, key.hexdigest())
+        hit = self.find_cached(cached)
+        if hit:
+            return hit
+        canvas = Image.new('RGB', (
+            max(screen['x'] + screen['width'] for screen, image in outputs),
+            max(screen['y'] + screen['height'] for screen, image in outputs)))
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+            # Pillow releases the GIL while decoding and resampling
+            tiles = list(pool.map(self.fill_screen, outputs))
+        for (screen, image), tile in zip(outputs, tiles):
+            canvas.paste(tile, (screen['x'], screen['y']))
+        composed = self.save(canvas, cached)
+        self.evict(composed)
+        return composed
+
+    def evict(self, keep):
+        """remove least recently applied renders, other than keep, until the
+        cache is under its limit"""
+        limit = self.get_cache_size()
+        entries, total = [], 0
+        with os.scandir(str(self.renderDirectory)) as files:
+            for entry in files:
+                if entry.name.startswith('.'):
+                    continue
+                st = entry.stat()
+                total += st.st_size
+                if entry.path != keep:
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        for mtime, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -34,8 +34,7 @@ TODO: ---
 OPTIONS: type rwal.py -h in a terminal
 REQUIREMENTS: Python3.2+, python3-pil, python3-tk, feh, xclip, and a supported
 desktop environment.
-BUGS: OSX innocuous error returned by Applescript, 'Duplicate Options' bug that
-      requires deletion of background.conf
+BUGS: OSX innocuous error returned by Applescript
 NOTES: Feh is used for Openbox and any unknown environment. KDE users must click
 Default Desktop Settings > Slideshow, apply "~/.config/rwal/kde-plasma", and
 may have to logout/login.
@@ -49,37 +48,151 @@ REVISION: 07/19/2020
 LICENSE: GPL 3.0, no warranty expressed or implied
 """
 import sys
+import time
+# startup timestamps reported by --profile-startup
+_started = time.perf_counter()
+import atexit
+import contextlib
 from pathlib import Path
+import instrument
 from state import State
 from config import Config
 from images import ImageCollector
 from environment import Environment
 from arguments import build_args
 from slideshow import SlideShow
+from daemon import Daemon
+from watcher import Watcher
 
 __author__ = 'Ike Davis'
+_imported = time.perf_counter()
 config = Config()
 state = State()
 rimage = ImageCollector()
 renv = Environment()
+_initialized = time.perf_counter()
 
 
 def set_background():
     # acquire image based on user options then apply to background
-    renv.set_state('pic', rimage.select_image())
-    renv.set_background()
+    with instrument.span('select'):
+        renv.set_state('pic', rimage.select_image())
+    with instrument.span('monitors'):
+        outputs = rimage.select_monitor_images()
+    with instrument.span('apply'):
+        if outputs:
+            renv.set_monitor_backgrounds(outputs)
+        else:
+            renv.set_background()
+
+
+def profile_startup(command_started):
+    """report import, init, and command cost; registered by
+    --profile-startup to run at exit"""
+    finished = time.perf_counter()
+    heavy = [name for name in ('PIL', 'tkinter', 'numpy', 'gi')
+             if name in sys.modules]
+    print('rwal startup profile (interpreter startup not included):',
+          file=sys.stderr)
+    for stage, seconds in (('imports', _imported - _started),
+                           ('initialization', _initialized - _imported),
+                           ('command', finished - command_started),
+                           ('total', finished - _started)):
+        print('  {:<16}{:>8.1f} ms'.format(stage, seconds * 1000),
+              file=sys.stderr)
+    print('  heavy modules loaded: {}'.format(', '.join(heavy) or 'none'),
+          file=sys.stderr)
+    print('  for per-module import times run: python3 -X importtime {}'
+          .format(sys.argv[0]), file=sys.stderr)
+
+
+@contextlib.contextmanager
+def collect_stats(args, argv):
+    """time and count the stages of a command for --stats and the Stats
+    Log; nothing is recorded when neither is set. A Stats Log set only in
+    rwal.conf starts recording once run() has loaded it."""
+    if args.stats or args.stats_log:
+        instrument.start()
+    try:
+        yield
+    finally:
+        if instrument.enabled:
+            # background.conf is otherwise written at exit, outside the
+            # report
+            with instrument.span('flush'):
+                state.flush_bgConfig()
+            report = instrument.finish(argv)
+            if args.stats:
+                print(instrument.format_report(report, args.stats),
+                      file=sys.stderr)
+            log = args.stats_log or config.get_stats_log()
+            if log:
+                instrument.append_log(log, report)
 
 
 def main(argv):
-    config.set_config()
-    config.set_bgconfig()
-    args = build_args(renv.get_state('desktopSession'))
+    args = build_args(renv.get_state('desktopSession'), argv)
+    if args.profile_startup:
+        atexit.register(profile_startup, time.perf_counter())
+    if args.daemon:
+        state.set_state('verbose', args.verbose)
+        config.set_config()
+        Watcher(config.get_watch_directories(), rimage.invalidate).start()
+        return Daemon().serve(dispatch)
+    # hand the request to a running daemon; commands that open an editor or
+    # loop for a long time always run in this process
+    if not (args.config or args.editbackground or args.slideshow):
+        status = Daemon().send_command(argv)
+        if status is not None:
+            return status
+    with collect_stats(args, argv):
+        run(args)
+
+
+def dispatch(argv):
+    """run one daemon request with freshly reset options"""
+    state.reset_state()
+    state.reload_bgConfig()
+    try:
+        args = build_args(renv.get_state('desktopSession'), argv)
+        with collect_stats(args, argv):
+            run(args)
+    finally:
+        state.flush_bgConfig()
+
+
+def run(args):
+    with instrument.span('config'):
+        config.set_config()
+        config.set_bgconfig()
+    if not instrument.enabled and config.get_stats_log():
+        instrument.start()
     state.set_state('verbose', args.verbose)
 
     if args.present:
         state.set_state('pwd', args.present)
+    if args.jobs:
+        state.set_state('jobs', args.jobs)
+    if args.render:
+        state.set_state('render_cache', args.render)
+    if args.selection:
+        state.set_state('selection', args.selection)
+    if args.rescan:
+        state.set_state('rescan', args.rescan)
     if args.filter:
         state.set_state('filter', args.filter[0])
+    if args.tolerance is not None:
+        state.set_state('tolerance', args.tolerance)
+    if args.min_width:
+        state.set_state('min_width', args.min_width)
+    if args.min_height:
+        state.set_state('min_height', args.min_height)
+    if args.monitor:
+        state.set_state('monitor', args.monitor[0])
+    if args.per_monitor:
+        state.set_state('per_monitor', args.per_monitor)
+    if args.dedupe:
+        state.set_state('dedupe', args.dedupe)
     if args.list:
         state.set_state('list', args.list[0])
     elif args.reshuffle:
@@ -105,6 +218,8 @@ def main(argv):
         sys.exit(rimage.get_record_background())
     elif args.editbackground:
         sys.exit(rimage.edit_background())
+    elif args.export:
+        sys.exit(rimage.export_images_list(args.export[0]))
     elif args.slideshow:
         slide = SlideShow()
         state.set_state('slideshow', True)
@@ -135,7 +250,4 @@ def main(argv):
 
 
 if __name__ == '__main__':
-    # profiling test
-    # import cProfile
-    # cProfile.run("sys.exit(main(sys.argv[1:]))")
     sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,35 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import json
+import errno
+import socket
+import time
+import tempfile
+import configparser
 import unittest
 from unittest.mock import Mock, patch, mock_open
 from images import ImageSelector, ImageCollector
+from environment import Environment
+from index import ImageIndex
+from metadata import MetadataCache
+from headers import probe_image
+from daemon import Daemon
+from watcher import Watcher
+from slideshow import SlideShow
+from imagelist import ImageList
+from state import State
+from arguments import build_args
+from screen import ScreenGeometry
+from history import FenwickTree, ShowHistory
+from shuffle import ShuffleBag
+from render import RenderCache
+from schedule import parse_schedule, Interval, Cron
+from backends import GSettingsBackend, XfconfBackend, FehBackend, \
+    KdeBackend
+import instrument
+from phash import BKTree, DuplicateIndex, hamming
 
 
 class TestImages(unittest.TestCase):
@@ -12,7 +39,7 @@ class TestImages(unittest.TestCase):
     selection.previous.return_value = 'previous'
     selection.first.return_value = 'first'
     selection.cli.return_value = 'commandline'
-    ming = Mock(name='imghdr')
+    ming = Mock(name='get_image_type')
     ming.return_value = True
 
     @patch('images.ImageSelector.select_random_image', selection.random)
@@ -78,7 +105,7 @@ class TestImages(unittest.TestCase):
     @patch('images.ImageCollector.record_background')
     @patch('images.ImageCollector.index_background')
     @patch('images.ImageCollector.skip_image')
-    @patch('images.imghdr.what', ming)
+    @patch('images.ImageCollector.get_image_type', ming)
     @patch('images.ImageCollector.write_images_list_file')
     @patch('builtins.open', mock_open(read_data='/img/mock.jpg\n/img/mock.png'))
     def test_select_image_ImageSelector(self, mo, im, ind, rec):
@@ -91,5 +118,889 @@ class TestImages(unittest.TestCase):
         self.assertEqual(call, '/img/mock.jpg')
 
 
+class TestImageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.library = os.path.join(self.tmp.name, 'library')
+        os.makedirs(os.path.join(self.library, 'sub'))
+        for name in ('a.jpg', 'notes.txt', os.path.join('sub', 'b.png')):
+            open(os.path.join(self.library, name), 'w').close()
+        self.index = ImageIndex()
+        self.index.indexFile = os.path.join(self.tmp.name, 'library.db')
+
+    def tearDown(self):
+        self.index.close_index()
+        self.tmp.cleanup()
+
+    def test_get_images(self):
+        images = self.index.get_images(self.library)
+        self.assertEqual(images, [os.path.join(self.library, 'a.jpg'),
+                                  os.path.join(self.library, 'sub', 'b.png')])
+
+    def test_get_images_present(self):
+        images = self.index.get_images(self.library, recursive=False)
+        self.assertEqual(images, [os.path.join(self.library, 'a.jpg')])
+
+    def test_refresh_changed_directory(self):
+        self.index.get_images(self.library)
+        os.remove(os.path.join(self.library, 'sub', 'b.png'))
+        os.rmdir(os.path.join(self.library, 'sub'))
+        open(os.path.join(self.library, 'c.jpg'), 'w').close()
+        images = self.index.get_images(self.library)
+        self.assertEqual(images, [os.path.join(self.library, 'a.jpg'),
+                                  os.path.join(self.library, 'c.jpg')])
+
+    def test_subtree_uses_index(self):
+        sibling = self.library + '-extra'
+        os.mkdir(sibling)
+        open(os.path.join(sibling, 'c.jpg'), 'w').close()
+        self.index.get_images(sibling)
+        self.assertEqual(len(self.index.get_images(self.library)), 2)
+        plan = ' '.join(row[-1] for row in self.index.open_index().execute(
+            'EXPLAIN QUERY PLAN SELECT path FROM files WHERE ' +
+            self.index.subtree('dir'), self.index.subtree_args(self.library)))
+        self.assertIn('USING INDEX', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_symlink_loop_skipped(self):
+        os.symlink('..', os.path.join(self.library, 'sub', 'loop'))
+        images = self.index.get_images(self.library)
+        self.assertEqual(images, [os.path.join(self.library, 'a.jpg'),
+                                  os.path.join(self.library, 'sub', 'b.png')])
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pic = os.path.join(self.tmp.name, 'wide.png')
+        Image.new('RGB', (32, 18)).save(self.pic)
+        self.corrupt = os.path.join(self.tmp.name, 'corrupt.jpg')
+        with open(self.corrupt, 'wb') as corrupt:
+            corrupt.write(b'not an image')
+        ImageIndex().indexFile = os.path.join(self.tmp.name, 'library.db')
+        self.cache = MetadataCache()
+
+    def tearDown(self):
+        ImageIndex().close_index()
+        self.tmp.cleanup()
+
+    def test_get_dimensions(self):
+        dimensions = self.cache.get_dimensions([self.pic, self.corrupt])
+        self.assertEqual(dimensions, {self.pic: (32, 18), self.corrupt: None})
+
+    def test_cached_dimensions(self):
+        self.cache.get_dimensions([self.pic])
+        with patch('metadata.MetadataCache.probe') as probe:
+            dimensions = self.cache.get_dimensions([self.pic])
+        probe.assert_not_called()
+        self.assertEqual(dimensions[self.pic], (32, 18))
+
+    def test_changed_file_probed(self):
+        from PIL import Image
+        self.cache.get_dimensions([self.pic])
+        Image.new('RGB', (40, 30)).save(self.pic)
+        os.utime(self.pic, ns=(0, 10 ** 9))
+        dimensions = self.cache.get_dimensions([self.pic])
+        self.assertEqual(dimensions[self.pic], (40, 30))
+
+    def test_indexed_file_edited_in_place(self):
+        from PIL import Image
+        ImageIndex().get_images(self.tmp.name)
+        self.cache.get_dimensions([self.pic])
+        # rewriting a file leaves its directory's mtime alone
+        directory = os.stat(self.tmp.name).st_mtime_ns
+        Image.new('RGB', (40, 30)).save(self.pic)
+        os.utime(self.pic, ns=(0, 10 ** 9))
+        os.utime(self.tmp.name, ns=(directory, directory))
+        dimensions = self.cache.get_dimensions([self.pic])
+        self.assertEqual(dimensions[self.pic], (40, 30))
+
+    def test_match_ratios(self):
+        from PIL import Image
+        laptop = os.path.join(self.tmp.name, 'laptop.png')
+        Image.new('RGB', (1366, 768)).save(laptop)
+        paths = [laptop, self.pic, self.corrupt]
+        hd1080 = [(16 / 9 * 0.99, 16 / 9 * 1.01)]
+        self.assertEqual(self.cache.match_ratios(paths, hd1080),
+                         [laptop, self.pic])
+        self.assertEqual(self.cache.match_ratios(paths, hd1080, 100), [laptop])
+        self.assertEqual(self.cache.match_ratios(
+            paths, [(4 / 3, 4 / 3), (1.7, 1.7)]), [])
+
+    def test_image_filter_multiple_ratios(self):
+        from PIL import Image
+        square = os.path.join(self.tmp.name, 'square.png')
+        Image.new('RGB', (20, 20)).save(square)
+        collector = ImageCollector()
+        collector.sourceImages = [square, self.pic, self.corrupt]
+        collector.set_state('filter', 'hd1080,1:1')
+        try:
+            self.assertEqual(collector.image_filter(), [square, self.pic])
+            collector.set_state('filter', 'sd480')
+            with self.assertRaises(SystemExit):
+                collector.image_filter()
+        finally:
+            collector.reset_state()
+
+    @patch.dict(os.environ, {'RWAL_SCREEN': 'A=32x18+0+0,B=40x30+32+0'})
+    def test_select_monitor_images(self):
+        from PIL import Image
+        square = os.path.join(self.tmp.name, 'square.png')
+        Image.new('RGB', (20, 20)).save(square)
+        standard = os.path.join(self.tmp.name, 'standard.png')
+        Image.new('RGB', (40, 30)).save(standard)
+        collector = ImageCollector()
+        collector.sourceImages = [square, self.pic, standard, self.corrupt]
+        collector.selectedImage = self.pic
+        collector.set_state('per_monitor', True)
+        try:
+            outputs = collector.select_monitor_images()
+        finally:
+            collector.reset_state()
+        self.assertEqual([(screen['name'], image) for screen, image in outputs],
+                         [('A', self.pic), ('B', standard)])
+
+    @patch.dict(os.environ, {'RWAL_SCREEN': 'A=32x18+0+0,B=40x30+32+0'})
+    @patch('images.ImageCollector.record_background')
+    @patch('images.ImageCollector.index_background')
+    def test_select_monitor_images_next(self, ind, rec):
+        from PIL import Image
+        standard = os.path.join(self.tmp.name, 'standard.png')
+        Image.new('RGB', (40, 30)).save(standard)
+        collector = ImageCollector()
+        # next steps through images.idx, so no directory is collected
+        collector._state.pop('imageDirectory', None)
+        collector.set_state('per_monitor', True)
+        try:
+            with patch('images.ImageSelector.select_next_image',
+                       return_value=self.pic):
+                collector.select_image('next')
+            outputs = collector.select_monitor_images()
+        finally:
+            collector.reset_state()
+        self.assertEqual([(screen['name'], image) for screen, image in outputs],
+                         [('A', self.pic), ('B', standard)])
+
+
+class TestHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_probe_formats(self):
+        from PIL import Image
+        for kind, ext, size in (('jpeg', 'jpg', (64, 36)),
+                                ('png', 'png', (30, 20)),
+                                ('bmp', 'bmp', (17, 9)),
+                                ('gif', 'gif', (8, 5)),
+                                ('tiff', 'tiff', (12, 13))):
+            pic = os.path.join(self.tmp.name, 'image.' + ext)
+            Image.new('RGB', size).save(pic)
+            with patch('headers.read_pillow') as fallback:
+                self.assertEqual(probe_image(pic), (kind,) + size)
+            fallback.assert_not_called()
+
+    def test_probe_corrupt(self):
+        pic = os.path.join(self.tmp.name, 'corrupt.jpg')
+        with open(pic, 'wb') as corrupt:
+            corrupt.write(b'\xff\xd8\xff\xe0')
+        self.assertIsNone(probe_image(pic))
+
+    def test_probe_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            probe_image(os.path.join(self.tmp.name, 'missing.png'))
+
+
+class TestDaemon(unittest.TestCase):
+
+    def request(self, dispatch, argv):
+        server, client = socket.socketpair()
+        request = dict(argv=argv, cwd=os.getcwd())
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        Daemon().handle(server, dispatch)
+        with client, client.makefile('rb') as stream:
+            return json.loads(stream.readline().decode('utf-8'))
+
+    def test_handle_output(self):
+        reply = self.request(lambda argv: print(' '.join(argv)), ['-n'])
+        self.assertEqual(reply, dict(stdout='-n\n', stderr='', status=0))
+
+    def test_handle_exit_message(self):
+        def dispatch(argv):
+            sys.exit('Invalid directory or file list!')
+        reply = self.request(dispatch, ['-d', '/missing'])
+        self.assertEqual(reply['stderr'], 'Invalid directory or file list!\n')
+        self.assertEqual(reply['status'], 1)
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'requires inotify')
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.library = os.path.join(self.tmp.name, 'library')
+        os.makedirs(self.library)
+        self.index = ImageIndex()
+        self.index.indexFile = os.path.join(self.tmp.name, 'library.db')
+        self.changes = []
+        self.watcher = Watcher([self.library], self.changes.append).start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.index.close_index()
+        self.tmp.cleanup()
+
+    def wait_for_change(self):
+        for attempt in range(50):
+            if self.changes:
+                return
+            time.sleep(0.05)
+
+    def test_new_image_indexed(self):
+        pic = os.path.join(self.library, 'new.jpg')
+        open(pic, 'w').close()
+        self.wait_for_change()
+        self.assertEqual(self.changes, [pic])
+        self.assertEqual(self.index.get_images(self.library), [pic])
+
+    @patch.dict(State._state, daemon=True)
+    def test_change_after_list_request(self):
+        collector = ImageCollector()
+        collector._state.pop('imageDirectory', None)
+        listed = os.path.join(self.tmp.name, 'images.txt')
+        collector.set_state('list', listed)
+        try:
+            with patch('images.ImageCollector.collect_images'), \
+                    patch('images.ImageCollector.write_images_list_file'):
+                collector.get_source_images()
+                # a directory request, cached after the -l one
+                collector.set_state('list', None)
+                collector.imageDirectory = self.library
+                collector.get_source_images()
+        finally:
+            collector.reset_state()
+        listKey, directoryKey = list(ImageCollector._sourceCache)
+        changes = []
+        watcher = Watcher([self.library], lambda path: (
+            collector.invalidate(path), changes.append(path))).start()
+        pic = os.path.join(self.library, 'new.jpg')
+        try:
+            open(pic, 'w').close()
+            for attempt in range(50):
+                if changes:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(changes, [pic])
+            self.assertEqual(list(ImageCollector._sourceCache), [listKey])
+            self.assertTrue(watcher.watchThread.is_alive())
+        finally:
+            watcher.stop()
+            ImageCollector._sourceCache.clear()
+
+    @patch('threading.excepthook', Mock())
+    @patch('watcher.InotifyWatcher.run', Mock(side_effect=RuntimeError))
+    def test_ended_watch_unwatched(self):
+        watcher = Watcher([self.library]).start()
+        watcher.watchThread.join()
+        self.assertFalse(self.index.is_watched(self.library))
+        watcher.stop()
+
+    def test_symlinks_not_watched(self):
+        os.symlink(self.tmp.name, os.path.join(self.library, 'loop'))
+        self.watcher.inotify.add_tree(self.library)
+        self.assertNotIn(os.path.join(self.library, 'loop'),
+                         self.watcher.inotify.watches.values())
+
+
+class TestSlideShow(unittest.TestCase):
+
+    @patch.dict(os.environ, DESKTOP_SESSION='openbox')
+    def setUp(self):
+        self.show = SlideShow()
+        self.show.images.sourceImages = ['/img/b.jpg', '/img/a.jpg']
+
+    @patch('slideshow.SlideShow.get_slides_refresh', Mock(return_value=0))
+    def test_iterate_slides_next(self):
+        self.show.build_slides('next')
+        slides = self.show.iterate_slides('next')
+        order = [next(slides) for count in range(3)]
+        self.assertEqual(order, ['/img/a.jpg', '/img/b.jpg', '/img/a.jpg'])
+
+    @patch('slideshow.SlideShow.get_slides_refresh', Mock(return_value=0))
+    @patch('images.ImageCollector.get_source_images')
+    def test_iterate_slides_refresh_on_change(self, collect):
+        def add_image():
+            self.show.images.sourceImages = ['/img/a.jpg', '/img/b.jpg',
+                                             '/img/c.jpg']
+        collect.side_effect = add_image
+        self.show.build_slides('next')
+        slides = self.show.iterate_slides('next')
+        next(slides)
+        collect.assert_not_called()
+        self.show.slidesChanged.set()
+        self.assertEqual([next(slides), next(slides)],
+                         ['/img/b.jpg', '/img/c.jpg'])
+        collect.assert_called_once()
+
+    @patch('slideshow.SlideShow.get_slides_refresh', Mock(return_value=0))
+    @patch('render.RenderCache.is_enabled', Mock(return_value=False))
+    @patch('images.ImageCollector.get_image_type')
+    def test_prepare_slide_skips_corrupt(self, image_type):
+        from concurrent.futures import ThreadPoolExecutor
+        image_type.side_effect = lambda path: \
+            None if path == '/img/a.jpg' else 'jpeg'
+        self.show.build_slides('next')
+        slides = self.show.iterate_slides('next')
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            upcoming = prefetch.submit(self.show.prepare_slide, slides)
+            self.assertEqual(upcoming.result(), '/img/b.jpg')
+            image_type.return_value = None
+            image_type.side_effect = None
+            upcoming = prefetch.submit(self.show.prepare_slide, slides)
+            with self.assertRaises(SystemExit):
+                upcoming.result()
+
+
+class TestImageList(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'images.idx')
+        ImageList.write(self.filename, ['/img/c.jpg', '/img/a.jpg',
+                                        '/img/b.jpg', '/img/a.jpg'])
+        self.images = ImageList(self.filename)
+
+    def tearDown(self):
+        self.images.close()
+        self.tmp.cleanup()
+
+    def test_sorted_unique(self):
+        self.assertEqual(len(self.images), 3)
+        self.assertEqual([self.images[n] for n in range(3)],
+                         ['/img/a.jpg', '/img/b.jpg', '/img/c.jpg'])
+        self.assertEqual(self.images[-1], '/img/c.jpg')
+
+    def test_index_and_bisect(self):
+        self.assertEqual(self.images.index('/img/b.jpg'), 1)
+        self.assertEqual(self.images.bisect('/img/bb.jpg'), 2)
+        with self.assertRaises(ValueError):
+            self.images.index('/img/bb.jpg')
+
+    def test_unchanged_list_not_rewritten(self):
+        written = ImageList.write(self.filename, ['/img/b.jpg', '/img/a.jpg',
+                                                  '/img/c.jpg'])
+        self.assertFalse(written)
+        self.assertTrue(ImageList.write(self.filename, ['/img/a.jpg']))
+        with ImageList(self.filename) as images:
+            self.assertEqual((len(images), images.generation), (1, 2))
+        self.assertEqual(os.listdir(self.tmp.name), ['images.idx'])
+
+    def test_export(self):
+        textfile = os.path.join(self.tmp.name, 'images.txt')
+        self.images.export(textfile)
+        with open(textfile) as exported:
+            self.assertEqual(exported.read().splitlines(),
+                             ['/img/a.jpg', '/img/b.jpg', '/img/c.jpg'])
+
+
+class TestBackgroundStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state = State()
+        self.saved = (self.state.bgFile, self.state.configDirectory)
+        self.state.configDirectory = self.tmp.name
+        self.state.bgFile = os.path.join(self.tmp.name, 'background.conf')
+        self.state.bgLoaded = False
+
+    def tearDown(self):
+        self.state.bgChanges.clear()
+        self.state.bgFile, self.state.configDirectory = self.saved
+        self.state.bgLoaded = False
+        self.tmp.cleanup()
+
+    def test_buffered_until_flush(self):
+        self.state.set_bgConfig('Current Background', '/img/a.jpg')
+        self.assertFalse(os.path.exists(self.state.bgFile))
+        self.assertEqual(self.state.get_bgConfig(), '/img/a.jpg')
+        self.state.flush_bgConfig()
+        with open(self.state.bgFile) as bgfile:
+            self.assertIn('current background = /img/a.jpg', bgfile.read())
+
+    def test_flush_merges_and_repairs_duplicates(self):
+        with open(self.state.bgFile, 'w') as bgfile:
+            bgfile.write('[Temp]\ncurrent directory = /img\n'
+                         'current background = /old.jpg\n'
+                         'current background = /older.jpg\n')
+        self.state.set_bgConfig('Current Background', '/img/b.jpg')
+        self.state.flush_bgConfig()
+        with open(self.state.bgFile) as bgfile:
+            contents = bgfile.read()
+        self.assertEqual(contents.count('current background'), 1)
+        self.assertIn('current directory = /img', contents)
+
+
+class TestScreenGeometry(unittest.TestCase):
+
+    XRANDR = ('Screen 0: minimum 8 x 8, current 4480 x 1440\n'
+              'HDMI-1 connected 1920x1080+2560+0 (normal) 527mm x 296mm\n'
+              '   1920x1080     60.00*+\n'
+              'DP-1 connected primary 2560x1440+0+0 (normal) 597mm x 336mm\n'
+              'DP-2 disconnected (normal left inverted right x axis y axis)\n')
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.geometry = ScreenGeometry()
+        self.saved = self.geometry.screenCache
+        self.geometry.screenCache = os.path.join(self.tmp.name, 'screens.json')
+        self.geometry.screens = None
+
+    def tearDown(self):
+        self.geometry.screenCache = self.saved
+        self.geometry.screens = None
+        self.tmp.cleanup()
+
+    @patch.dict(os.environ, {'DISPLAY': ':0', 'RWAL_SCREEN': ''})
+    @patch('screen.shutil.which', return_value='/usr/bin/xrandr')
+    @patch('screen.subprocess.run')
+    def test_xrandr_primary_first_and_cached(self, run, which):
+        run.return_value = Mock(stdout=self.XRANDR)
+        self.assertEqual(self.geometry.get_screen(),
+                         dict(name='DP-1', width=2560, height=1440, x=0, y=0))
+        self.assertEqual(self.geometry.get_screen('HDMI-1')['x'], 2560)
+        self.assertEqual(len(self.geometry.get_screens()), 2)
+        # a new process in the same session reads the cache file instead
+        self.geometry.screens = None
+        self.geometry.get_screens()
+        self.assertEqual(run.call_count, 1)
+
+    @patch.dict(os.environ, {'RWAL_SCREEN': 'left=1920x1200+0+0,3840x2160'})
+    def test_override(self):
+        screens = self.geometry.get_screens()
+        self.assertEqual([s['name'] for s in screens], ['left', 'screen1'])
+        self.assertEqual(screens[1]['width'] / screens[1]['height'], 16 / 9)
+
+
+class TestShowHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        ImageIndex().indexFile = os.path.join(self.tmp.name, 'library.db')
+        self.history = ShowHistory()
+        self.history.historyPaths = None
+
+    def tearDown(self):
+        ImageIndex().close_index()
+        self.tmp.cleanup()
+
+    def test_fenwick_find(self):
+        tree = FenwickTree([1, 0, 3, 2])
+        self.assertEqual([tree.find(v) for v in (0, 0.5, 1, 3.9, 4, 5.5, 6)],
+                         [0, 0, 2, 2, 3, 3, 3])
+        tree.update(2, 0)
+        self.assertEqual(tree.total, 3)
+        self.assertEqual(tree.find(1.5), 3)
+
+    def test_record(self):
+        self.history.record('/img/a.jpg')
+        self.history.record('/img/a.jpg')
+        shown, count = self.history.get_history()['/img/a.jpg']
+        self.assertEqual(count, 2)
+        self.assertAlmostEqual(shown, time.time(), delta=60)
+
+    def test_choose_prefers_unseen(self):
+        paths = ['/img/{}.jpg'.format(n) for n in range(4)]
+        for path in paths[1:]:
+            self.history.record(path)
+        # the never-shown image outweighs the rest several thousand times
+        self.assertEqual(self.history.choose(paths), '/img/0.jpg')
+        # once picked, it is weighted like the others without a rebuild
+        self.assertEqual(self.history.historyTree.weights, [60] * 4)
+
+    def test_tree_kept_for_source(self):
+        paths = ['/img/{}.jpg'.format(n) for n in range(4)]
+        self.history.choose(list(paths), 'source')
+        self.history.historyTree.update(2, 5)
+        # a daemon hands over a fresh copy of the source list each request
+        with patch('history.ShowHistory.get_history') as get_history:
+            self.history.choose(list(paths), 'source')
+            get_history.assert_not_called()
+        self.assertIn(5, self.history.historyTree.weights)
+        self.history.record('/img/2.jpg')
+        self.assertEqual(self.history.historyTree.weights[2], 60)
+
+
+class TestShuffleBag(TestBackgroundStore):
+
+    def setUp(self):
+        super(TestShuffleBag, self).setUp()
+        self.bag = ShuffleBag()
+        self.paths = ['/img/{}.jpg'.format(n) for n in range(6)]
+
+    def restart(self):
+        self.bag.flush_bgConfig()
+        self.bag.bgLoaded = False
+        self.bag.bagPaths = None
+
+    def test_every_image_once_across_restarts(self):
+        shown = []
+        for n in range(6):
+            shown.append(self.bag.choose(self.paths, 'source'))
+            self.restart()
+        self.assertEqual(sorted(shown), self.paths)
+        # a new round starts once the bag is empty
+        self.assertIn(self.bag.choose(self.paths, 'source'), self.paths)
+
+    def test_changed_source_keeps_round(self):
+        shown = [self.bag.choose(self.paths, 'source') for n in range(3)]
+        remaining = [path for path in self.paths if path not in shown]
+        changed = remaining[1:] + ['/img/new.jpg']
+        # the two unseen images still come before any repeat
+        picks = [self.bag.choose(changed, 'source') for n in range(2)]
+        self.assertFalse(set(picks) & set(shown))
+        self.assertNotIn(remaining[0], picks)
+
+    @patch.dict(State._state, daemon=True)
+    def test_daemon_order_kept(self):
+        name = self.bag.source_name('source')
+        self.bag.choose(list(self.paths), 'source')
+        stored = self.bag.bgConfig.get('Shuffle', name)
+        # a daemon hands over a fresh copy of the source list each request
+        with patch('shuffle.ShuffleBag.keyed') as keyed:
+            second = self.bag.choose(list(self.paths), 'source')
+        keyed.assert_not_called()
+        # a single pick scans for the same image the sorted round gives
+        self.bag.set_bgConfig(name, stored, section='Shuffle')
+        with patch.dict(State._state, daemon=False):
+            self.assertEqual(self.bag.choose(self.paths, 'source'), second)
+
+
+@patch.dict(os.environ, {'RWAL_SCREEN': '160x90'})
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pic = os.path.join(self.tmp.name, 'photo.jpg')
+        Image.new('RGB', (640, 480), 'red').save(self.pic)
+        self.cache = RenderCache()
+        self.cache.renderDirectory = os.path.join(self.tmp.name, 'render')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rendered_size(self, mode):
+        from PIL import Image
+        with Image.open(self.cache.render(self.pic, mode)) as rendered:
+            return rendered.size
+
+    def test_placements(self):
+        self.assertEqual(self.rendered_size('zoom'), (160, 90))
+        self.assertEqual(self.rendered_size('--bg-max'), (120, 90))
+        self.assertEqual(self.rendered_size('1'), (160, 90))
+        self.assertEqual(self.cache.render(self.pic, '--bg-tile'), self.pic)
+        # KDE, Windows and macOS place the image themselves
+        self.assertEqual(self.cache.render(self.pic, None), self.pic)
+
+    def test_cache_outside_config(self):
+        with patch.dict(os.environ, XDG_CACHE_HOME=self.tmp.name):
+            cache = RenderCache()
+        self.assertEqual(str(cache.renderDirectory),
+                         os.path.join(self.tmp.name, 'rwal', 'render'))
+
+    def test_cached_and_evicted(self):
+        first = self.cache.render(self.pic, 'zoom')
+        with patch('render.RenderCache.render_file') as render_file:
+            self.assertEqual(self.cache.render(self.pic, 'zoom'), first)
+        render_file.assert_not_called()
+        with patch('render.RenderCache.get_cache_size', return_value=0):
+            second = self.cache.render(self.pic, 'stretched')
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_compose_spans_monitors(self):
+        from PIL import Image
+        other = os.path.join(self.tmp.name, 'other.png')
+        Image.new('RGB', (30, 40), 'blue').save(other)
+        composed = self.cache.compose([
+            (dict(name='A', x=0, y=0, width=160, height=90), self.pic),
+            (dict(name='B', x=160, y=0, width=90, height=160), other)])
+        with Image.open(composed) as span:
+            self.assertEqual(span.size, (250, 160))
+            self.assertGreater(span.getpixel((10, 10))[0], 200)
+            self.assertGreater(span.getpixel((200, 150))[2], 200)
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_schedule('2.5').period, 2.5)
+        self.assertEqual(parse_schedule('10m').period, 600)
+        self.assertIsInstance(parse_schedule('@hourly'), Cron)
+        for invalid in ('0', 'soon', '61 * * * *', '*/0 * * * *'):
+            with self.assertRaises(ValueError):
+                parse_schedule(invalid)
+
+    def test_impossible_date(self):
+        with self.assertRaises(ValueError):
+            parse_schedule('0 0 30 2 *')
+        self.assertIsInstance(parse_schedule('0 0 29 2 *'), Cron)
+
+    def test_cron_next_time(self):
+        from datetime import datetime
+        weekdays = Cron('*/15 9-17 * * 1-5')
+        # Saturday noon, then Monday morning
+        self.assertEqual(weekdays.next_time(datetime(2026, 10, 17, 12, 0)),
+                         datetime(2026, 10, 19, 9, 0))
+        self.assertEqual(weekdays.next_time(datetime(2026, 10, 19, 9, 7, 30)),
+                         datetime(2026, 10, 19, 9, 15))
+        self.assertEqual(Cron('0 0 29 2 *').next_time(datetime(2026, 3, 1)),
+                         datetime(2028, 2, 29))
+
+    @patch('schedule.set_timer_slack', Mock())
+    @patch('schedule.time')
+    def test_interval_absolute_deadlines(self, clock):
+        interval = Interval(10)
+        clock.monotonic.return_value = 100
+        interval.start()
+        # work done during the period doesn't push the next change back
+        clock.monotonic.return_value = 103
+        interval.wait()
+        clock.sleep.assert_called_with(7)
+        # deadlines missed while suspended are skipped
+        clock.monotonic.return_value = 145
+        interval.wait()
+        clock.sleep.assert_called_with(5)
+        self.assertEqual(interval.deadline, 150)
+
+
+@patch('backends.subprocess.run')
+class TestBackends(unittest.TestCase):
+
+    def test_gsettings_without_shell(self, run):
+        GSettingsBackend('org.gnome.desktop.background', 'picture-uri', True,
+                         False).apply('/img/a b.jpg', 'zoom')
+        self.assertEqual(run.call_args_list[-1][0][0], [
+            'gsettings', 'set', 'org.gnome.desktop.background',
+            'picture-uri', 'file:///img/a b.jpg'])
+        self.assertNotIn('shell', run.call_args[1])
+
+    def test_xfconf_one_process_per_property(self, run):
+        run.return_value = Mock(returncode=0, stdout=(
+            '/backdrop/screen0/monitor0/workspace0/last-image   /img/a.jpg\n'
+            '/backdrop/screen0/monitor1/workspace0/last-image   /img/b.jpg\n'
+            '/backdrop/screen0/monitor1/workspace0/image-style  5\n'))
+        XfconfBackend(False).apply('/img/a.jpg', '4')
+        commands = [call[0][0] for call in run.call_args_list[1:]]
+        values = [command[-1] for command in commands]
+        # monitor0 already shows the image, so it is cleared to reload
+        self.assertEqual(values, ['', '/img/a.jpg', '4', '/img/a.jpg', '4'])
+
+    def test_xfconf_image_per_monitor(self, run):
+        run.return_value = Mock(returncode=0, stdout=(
+            '/backdrop/screen0/monitorDP-1/workspace0/last-image  /x.jpg\n'
+            '/backdrop/screen0/monitor1/workspace0/last-image  /x.jpg\n'))
+        outputs = [(dict(name='HDMI-1'), '/img/a.jpg'),
+                   (dict(name='DP-1'), '/img/b.jpg')]
+        XfconfBackend(False).apply_outputs(outputs, None)
+        applied = {call[0][0][4]: call[0][0][-1]
+                   for call in run.call_args_list[1:]}
+        self.assertEqual(applied, {
+            '/backdrop/screen0/monitorDP-1/workspace0/last-image': '/img/b.jpg',
+            '/backdrop/screen0/monitor1/workspace0/last-image': '/img/b.jpg'})
+
+    def test_feh_images_in_monitor_order(self, run):
+        FehBackend().apply_outputs([({}, '/img/a.jpg'), ({}, '/img/b.jpg')],
+                                   '--bg-fill')
+        run.assert_called_once_with(['feh', '--bg-fill', '/img/a.jpg',
+                                     '/img/b.jpg'])
+
+    def test_feh_without_mode(self, run):
+        FehBackend().apply('/img/a.jpg', False)
+        run.assert_called_once_with(['feh', '/img/a.jpg'])
+
+    @patch.dict(os.environ, {'DESKTOP_SESSION': 'openbox'})
+    def test_invalid_mode_falls_back(self, run):
+        env = Environment()
+        with tempfile.NamedTemporaryFile('w', suffix='.conf') as conf, \
+                patch.object(env, 'configFile', conf.name), \
+                patch.object(env, 'config', configparser.ConfigParser()), \
+                patch.object(env, 'configLoaded', False):
+            conf.write('[Wallpaper Modes]\nOpenbox = --bg-sideways\n'
+                       'LXDE = fit\n')
+            conf.flush()
+            self.assertEqual(env.get_mode('openbox'), '--bg-max')
+            self.assertEqual(env.get_mode('lxde'), 'fit')
+
+
+class TestKdeBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, 'kde-plasma')
+        os.mkdir(self.folder)
+        self.pictures = []
+        for name in ('a.jpg', 'b.png'):
+            self.pictures.append(os.path.join(self.tmp.name, name))
+            with open(self.pictures[-1], 'wb') as picture:
+                picture.write(name.encode())
+        self.kde = KdeBackend(self.folder)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_link_swap(self):
+        with open(os.path.join(self.folder, 'old copy.jpg'), 'w'):
+            pass
+        self.kde.apply(self.pictures[0], None)
+        target = os.path.join(self.folder, 'rwal-wallpaper.jpg')
+        self.assertEqual(os.listdir(self.folder), ['rwal-wallpaper.jpg'])
+        self.assertTrue(os.path.samefile(target, self.pictures[0]))
+        self.kde.apply(self.pictures[1], None)
+        self.assertEqual(os.listdir(self.folder), ['rwal-wallpaper.png'])
+
+    def test_same_image_twice(self):
+        self.kde.apply(self.pictures[0], None)
+        self.kde.apply(self.pictures[0], None)
+        self.assertEqual(os.listdir(self.folder), ['rwal-wallpaper.jpg'])
+
+    @patch('backends.os.link',
+           side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+    def test_symlink_across_filesystems(self, link):
+        self.kde.apply(self.pictures[0], None)
+        target = os.path.join(self.folder, 'rwal-wallpaper.jpg')
+        self.assertEqual(os.readlink(target), self.pictures[0])
+
+
+
+class TestDuplicateIndex(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image, ImageDraw
+        self.tmp = tempfile.TemporaryDirectory()
+        ImageIndex().indexFile = os.path.join(self.tmp.name, 'library.db')
+        self.paths = {}
+        for name, size, shapes in (('large.jpg', (640, 360), 0),
+                                   ('small.jpg', (320, 180), 0),
+                                   ('other.png', (640, 360), 1)):
+            picture = Image.new('RGB', (640, 360), 'white')
+            draw = ImageDraw.Draw(picture)
+            if shapes:
+                draw.rectangle((320, 0, 640, 180), fill='black')
+                draw.rectangle((0, 180, 320, 360), fill='black')
+            else:
+                draw.ellipse((40, 40, 300, 300), fill='navy')
+                draw.rectangle((400, 100, 600, 340), fill='orange')
+            self.paths[name] = os.path.join(self.tmp.name, name)
+            picture.resize(size).save(self.paths[name])
+        self.index = DuplicateIndex()
+
+    def tearDown(self):
+        ImageIndex().close_index()
+        self.tmp.cleanup()
+
+    def test_bktree_search(self):
+        import random
+        rng = random.Random(1)
+        values = [rng.getrandbits(64) for item in range(300)]
+        tree = BKTree()
+        for item, value in enumerate(values):
+            tree.add(value, item)
+        target = values[0] ^ 0b1011
+        self.assertEqual(
+            sorted(tree.search(target, 10)),
+            [item for item, value in enumerate(values)
+             if hamming(value, target) <= 10])
+
+    def test_collapse_keeps_largest(self):
+        paths = [self.paths[name] for name in
+                 ('small.jpg', 'other.png', 'large.jpg')]
+        self.assertEqual(self.index.find_duplicates(paths),
+                         [[self.paths['large.jpg'], self.paths['small.jpg']]])
+        self.assertEqual(self.index.collapse(paths),
+                         [self.paths['other.png'], self.paths['large.jpg']])
+
+    def test_tree_kept_for_source(self):
+        paths = list(self.paths.values())
+        self.index.find_duplicates(paths, 'source')
+        tree = self.index.duplicateTree
+        remaining = [self.paths['small.jpg'], self.paths['other.png']]
+        self.assertEqual(self.index.find_duplicates(remaining, 'source'), [])
+        self.assertIs(self.index.duplicateTree, tree)
+
+    def test_cached_hashes(self):
+        paths = list(self.paths.values())
+        hashes = self.index.get_hashes(paths)
+        with patch('phash.DuplicateIndex.hash_file') as hash_file:
+            self.assertEqual(self.index.get_hashes(paths), hashes)
+        hash_file.assert_not_called()
+
+
+class TestJobs(unittest.TestCase):
+
+    def test_jobs_below_one_rejected(self):
+        self.assertEqual(build_args('openbox', ['-j', '2']).jobs, 2)
+        for jobs in ('0', '-1'):
+            with patch('sys.stderr'), self.assertRaises(SystemExit):
+                build_args('openbox', ['-j', jobs])
+
+    def test_config_jobs_clamped(self):
+        state = State()
+        config = configparser.ConfigParser()
+        config['Defaults'] = {'Jobs': '-2'}
+        with patch.object(state, 'config', config), \
+                patch.object(state, 'configLoaded', True):
+            self.assertEqual(state.get_jobs(), 1)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def tearDown(self):
+        if instrument.enabled:
+            instrument.finish()
+
+    def test_disabled_records_nothing(self):
+        instrument.start()
+        instrument.finish()
+        with instrument.span('scan'):
+            instrument.count('stat')
+        self.assertEqual(instrument.spans, {})
+        self.assertNotIn('stat', instrument.counters)
+
+    def test_nested_spans_and_counters(self):
+        instrument.start()
+        with instrument.span('select'):
+            for attempt in range(2):
+                with instrument.span('scan'):
+                    instrument.count('stat', 3)
+        instrument.count('subprocess')
+        report = instrument.finish(['-n'])
+        self.assertEqual([(entry['name'], entry['count'])
+                          for entry in report['spans']],
+                         [('select', 1), ('select/scan', 2)])
+        self.assertEqual(report['counters']['stat'], 6)
+        self.assertEqual(report['counters']['subprocess'], 1)
+        self.assertEqual(report['argv'], ['-n'])
+        self.assertEqual(json.loads(instrument.format_report(report, 'json')),
+                         report)
+        self.assertIn("    scan x2", instrument.format_report(report))
+
+    def test_log_rolls_over(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'logs', 'stats.jsonl')
+            instrument.append_log(log, dict(ms=1))
+            with patch('instrument.LOG_SIZE', 1):
+                instrument.append_log(log, dict(ms=2))
+            with open(log) as current, open(log + '.1') as previous:
+                self.assertEqual(json.loads(current.read()), dict(ms=2))
+                self.assertEqual(json.loads(previous.read()), dict(ms=1))
+
+
 if __name__ == '__main__':
     unittest.main()
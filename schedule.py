@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Module for timing slideshow changes against absolute deadlines, either every
+DELAY seconds or on a cron-like schedule"""
+import re
+import sys
+import time
+import datetime
+
+# cron field ranges: minute, hour, day of month, month, day of week
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+NICKNAMES = {'@hourly': '0 * * * *', '@daily': '0 0 * * *',
+             '@midnight': '0 0 * * *', '@weekly': '0 0 * * 0',
+             '@monthly': '0 0 1 * *'}
+DURATION = re.compile(r'^(\d+(?:\.\d*)?|\.\d+)(ms|s|m|h)?$')
+UNITS = dict(ms=0.001, s=1, m=60, h=3600)
+
+
+def parse_schedule(text):
+    """Interval for a delay such as 5, 0.5, 90s, 10m or 1.5h; Cron for a
+    five-field crontab expression or @hourly, @daily, @weekly, @monthly.
+    Raises ValueError for anything else."""
+    text = NICKNAMES.get(text.strip(), text.strip())
+    if len(text.split()) == 5:
+        return Cron(text)
+    match = DURATION.match(text)
+    if not match:
+        raise ValueError('invalid schedule: {}'.format(text))
+    seconds = float(match.group(1)) * UNITS[match.group(2) or 's']
+    if seconds <= 0:
+        raise ValueError('DELAY must be greater than 0.')
+    return Interval(seconds)
+
+
+def set_timer_slack(seconds):
+    """let Linux coalesce this thread's timer wakeups with others', saving
+    power; the slack is kept small next to the period"""
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        import ctypes
+        ctypes.CDLL(None).prctl(29, int(seconds * 1e9), 0, 0, 0)  # SET_TIMERSLACK
+    except (OSError, AttributeError):
+        pass
+
+
+class Interval:
+    """changes every period seconds from start(), on the monotonic clock;
+    deadlines missed, say during suspend, are skipped rather than made up"""
+
+    def __init__(self, period):
+        self.period = period
+        self.deadline = None
+
+    def start(self):
+        self.deadline = time.monotonic()
+        set_timer_slack(min(self.period / 100, 1))
+
+    def wait(self):
+        """sleep once, until the next deadline"""
+        self.deadline += self.period
+        now = time.monotonic()
+        if self.deadline <= now:
+            missed = (now - self.deadline) // self.period + 1
+            self.deadline += missed * self.period
+        time.sleep(self.deadline - now)
+
+    def remaining(self, count):
+        return 'over {} minutes'.format(round(count * self.period / 60, 2))
+
+
+class Cron:
+    """changes at the wall-clock minutes matched by a crontab expression;
+    days of month and week match either one when both are restricted"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self.parse_field(field, low, high)
+            for field, (low, high) in zip(fields, FIELDS)]
+        # cron counts Sunday as 0 or 7, Python's weekday() Monday as 0
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.anyDay, self.anyWeekday = fields[2] == '*', fields[4] == '*'
+        # fail while parsing on dates that never come, such as 30 February
+        self.next_time(datetime.datetime.now())
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            span, slash, step = part.partition('/')
+            if span == '*':
+                start, end = low, high
+            elif '-' in span:
+                start, end = (int(bound) for bound in span.split('-', 1))
+            else:
+                start = int(span)
+                end = high if slash else start
+            step = int(step) if slash else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('invalid schedule field: {}'.format(field))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = moment.weekday() in self.weekdays
+        if self.anyDay or self.anyWeekday:
+            return day and weekday
+        return day or weekday
+
+    def next_time(self, after):
+        """first matching minute after the given datetime"""
+        moment = after.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+        # leap days recur within four years, plus slack for the century rule
+        limit = moment + datetime.timedelta(days=366 * 8)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) +
+                          datetime.timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + \
+                    datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + \
+                    datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError('schedule never matches: {}'.format(self.expression))
+
+    def start(self):
+        set_timer_slack(1)
+
+    def wait(self):
+        """sleep until the next matching minute; the wall clock is checked
+        at most once a minute, so suspend and clock changes are followed"""
+        target = time.mktime(self.next_time(
+            datetime.datetime.now()).timetuple())
+        while True:
+            remaining = target - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 60))
+
+    def remaining(self, count):
+        return 'next at {}'.format(
+            self.next_time(datetime.datetime.now()).strftime('%Y-%m-%d %H:%M'))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Module for detecting monitor geometry cheaply, without opening a window"""
+import os
+import re
+import json
+import glob
+import shutil
+import subprocess
+from pathlib import Path
+import instrument
+from state import State
+
+# xrandr output line, e.g. 'DP-1 connected primary 2560x1440+0+0 (normal...'
+XRANDR_OUTPUT = re.compile(
+    r'^(\S+) connected (primary )?(\d+)x(\d+)\+(\d+)\+(\d+)', re.MULTILINE)
+# override format, e.g. 'DP-1=2560x1440+0+0,HDMI-1=1920x1080' or '1920x1080'
+OVERRIDE = re.compile(r'^(?:(\S+)=)?(\d+)x(\d+)(?:\+(\d+)\+(\d+))?$')
+
+
+def screen(name, width, height, x=0, y=0):
+    return dict(name=name, width=int(width), height=int(height),
+                x=int(x or 0), y=int(y or 0))
+
+
+class ScreenGeometry(State):
+    """per-monitor geometry, tried from the environment override RWAL_SCREEN,
+    a per-session cache, xrandr, /sys/class/drm, and lastly Tkinter"""
+
+    def __init__(self):
+        super(ScreenGeometry, self).__init__()
+        if 'screens' not in self._state:
+            self.screens = None
+            self.screensKey = None
+            self.screenCache = Path(self.configDirectory, 'screens.json')
+
+    def from_override(self):
+        value = os.environ.get('RWAL_SCREEN', '').strip()
+        screens = []
+        for number, item in enumerate(filter(None, value.split(','))):
+            match = OVERRIDE.match(item.strip())
+            if not match:
+                print('Invalid RWAL_SCREEN value: {}'.format(item))
+                return []
+            name, width, height, x, y = match.groups()
+            screens.append(screen(name or 'screen{}'.format(number),
+                                  width, height, x, y))
+        return screens
+
+    def from_xrandr(self):
+        if not os.environ.get('DISPLAY') or not shutil.which('xrandr'):
+            return []
+        instrument.count('subprocess')
+        try:
+            # --current reports the known configuration without reprobing
+            output = subprocess.run(['xrandr', '--current'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    universal_newlines=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError):
+            return []
+        screens = []
+        for name, primary, width, height, x, y in XRANDR_OUTPUT.findall(output):
+            entry = screen(name, width, height, x, y)
+            # primary output first, so it is the default filter target
+            if primary:
+                screens.insert(0, entry)
+            else:
+                screens.append(entry)
+        return screens
+
+    def from_drm(self):
+        screens = []
+        for connector in sorted(glob.glob('/sys/class/drm/card*-*')):
+            try:
+                with open(os.path.join(connector, 'status')) as status:
+                    if status.read().strip() != 'connected':
+                        continue
+                with open(os.path.join(connector, 'modes')) as modes:
+                    mode = modes.readline().strip()
+            except OSError:
+                continue
+            match = re.match(r'(\d+)x(\d+)', mode)
+            if match:
+                # drop the 'cardN-' prefix to match xrandr output names
+                name = os.path.basename(connector).split('-', 1)[1]
+                screens.append(screen(name, *match.groups()))
+        return screens
+
+    def from_tkinter(self):
+        if not self.modules['Tkinter']:
+            return []
+        import tkinter as tk
+        with instrument.span('tkinter'):
+            try:
+                root = tk.Tk()
+            except tk.TclError:  # no display
+                return []
+            try:
+                return [screen('screen0', root.winfo_screenwidth(),
+                               root.winfo_screenheight())]
+            finally:
+                root.destroy()
+
+    def session_key(self):
+        """identifies the graphical session and its connected outputs, so the
+        cache is dropped after logout or when a monitor is plugged in"""
+        statuses = []
+        for status in sorted(glob.glob('/sys/class/drm/card*-*/status')):
+            try:
+                with open(status) as connected:
+                    statuses.append(connected.read().strip())
+            except OSError:
+                continue
+        return '|'.join([os.environ.get('XDG_SESSION_ID', ''),
+                         os.environ.get('DISPLAY', ''),
+                         os.environ.get('WAYLAND_DISPLAY', '')] + statuses)
+
+    def read_cache(self, key):
+        try:
+            with open(str(self.screenCache)) as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return None
+        if cached.get('session') == key:
+            return cached.get('screens')
+
+    def write_cache(self, key, screens):
+        try:
+            with open(str(self.screenCache), 'w') as cache:
+                json.dump(dict(session=key, screens=screens), cache)
+        except OSError:
+            pass
+
+    def get_screens(self):
+        """list of dicts with name, width, height, x and y; the primary or
+        first monitor comes first"""
+        override = self.from_override()
+        if override:
+            return override
+        key = self.session_key()
+        if self.screens is None or key != self.screensKey:
+            self.screensKey = key
+            self.screens = self.read_cache(key)
+            if not self.screens:
+                with instrument.span('screens'):
+                    self.screens = self.from_xrandr() or self.from_drm() or \
+                        self.from_tkinter()
+                if self.screens:
+                    self.write_cache(key, self.screens)
+        return self.screens or []
+
+    def get_screen(self, name=None):
+        """geometry of the named monitor, or of the primary one"""
+        screens = self.get_screens()
+        for entry in screens:
+            if name is None or entry['name'] == name:
+                return entry
+        if name is not None:
+            print('No monitor named {}; available: {}'.format(
+                name, ', '.join(entry['name'] for entry in screens)))
+        return None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Module for shuffle-bag selection: every image in a source is shown once, in
+a random order, before any is repeated, across separate invocations"""
+import os
+import bisect
+from state import State
+from imagelist import encode
+
+
+class ShuffleBag(State):
+    """the order of a round is each path's keyed hash under a random seed, so
+    only the seed and the hash of the last image shown are stored, under
+    [Shuffle] in background.conf. Images added during a round join it if
+    their hash is still ahead of the cursor; removed images just drop out."""
+
+    def __init__(self):
+        super(ShuffleBag, self).__init__()
+        # hash order of the most recent source and seed, kept between picks
+        # by a daemon or slideshow
+        if 'bagOrder' not in self._state:
+            self.bagOrder = None
+            self.bagKeys = None
+            self.bagPaths = None
+            self.bagSource = None
+
+    @staticmethod
+    def source_name(source):
+        """background.conf option name for a source, such as the key of
+        ImageCollector.get_source_images()"""
+        import hashlib
+        return hashlib.blake2b(repr(source).encode('utf-8', 'surrogateescape'),
+                               digest_size=8).hexdigest()
+
+    def load(self, name):
+        """(seed, cursor) of a source; a new seed if it has none"""
+        self.read_bgConfig()
+        seed, colon, cursor = self.bgConfig.get(
+            'Shuffle', name, fallback='').partition(':')
+        try:
+            seed, cursor = bytes.fromhex(seed), int(cursor)
+        except ValueError:
+            seed = b''
+        if len(seed) != 16:
+            return os.urandom(16), -1
+        return seed, cursor
+
+    @staticmethod
+    def keyed(paths, seed):
+        """(keyed hash, path) for each path"""
+        import hashlib
+        return ((int.from_bytes(hashlib.blake2b(
+            encode(path), key=seed, digest_size=8).digest(), 'big'), path)
+            for path in paths)
+
+    def order(self, paths, source, seed):
+        """paths sorted by keyed hash, computed once per source and seed;
+        the list is compared too, since a source's images can change"""
+        if self.bagSource != (source, seed) or self.bagPaths != paths:
+            self.bagOrder = sorted(self.keyed(paths, seed))
+            self.bagKeys = [key for key, path in self.bagOrder]
+            self.bagPaths, self.bagSource = list(paths), (source, seed)
+        return self.bagOrder
+
+    def find_next(self, paths, source, seed, cursor):
+        """(key, path) of the first image after cursor in the round's order,
+        or None once the round is over. A single pick needs only one pass
+        for the smallest key above the cursor; a daemon or slideshow sorts
+        the round once, then bisects it."""
+        if self._state['daemon'] or self._state['slideshow']:
+            order = self.order(paths, source, seed)
+            position = bisect.bisect_right(self.bagKeys, cursor)
+            return order[position] if position < len(order) else None
+        return min((item for item in self.keyed(paths, seed)
+                    if item[0] > cursor), default=None)
+
+    def choose(self, paths, source):
+        """the image after the cursor in this round's order, starting a new
+        round with a fresh seed once every image has been shown"""
+        name = self.source_name(source)
+        seed, cursor = self.load(name)
+        found = self.find_next(paths, source, seed, cursor)
+        if found is None:
+            if self._state['verbose']:
+                print('Every image has been shown: reshuffling.')
+            seed = os.urandom(16)
+            found = self.find_next(paths, source, seed, -1)
+        key, path = found
+        self.set_bgConfig(name, '{}:{}'.format(seed.hex(), key),
+                          section='Shuffle')
+        return path
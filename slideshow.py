@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 """A module that turns the user background into a slideshow."""
 
-import sys, os, time, subprocess
+import sys, os, time, random, bisect, subprocess, threading
+import instrument
 from state import State
 from images import ImageCollector
 from environment import Environment
+from watcher import Watcher
+from history import ShowHistory
+from shuffle import ShuffleBag
+from render import RenderCache
+from schedule import parse_schedule
 from pathlib import Path
 
 
@@ -13,6 +19,10 @@ class SlideShow(State):
         super(SlideShow, self).__init__()
         self.images = ImageCollector()
         self.env = Environment()
+        # slideshow order, built once from the collected images
+        self.slides = []
+        # set by the watcher when the slideshow directory changes
+        self.slidesChanged = threading.Event()
 
     def start_slideshow(self, directory, delay, count, switch):
         listExt = ('.txt', '.list')
@@ -26,7 +36,10 @@ class SlideShow(State):
         if switch == 'alpha':
             switch = 'next'
 
-        delay = int(delay)
+        try:
+            schedule = parse_schedule(delay)
+        except ValueError as error:
+            sys.exit(error)
         count = int(count)
         # check directory to match forms '1' through '5' and
         # 'directory1' through 'directory5', or path
@@ -41,32 +54,39 @@ class SlideShow(State):
             directory = self._state['directory']
         else:
             sys.exit('Invalid directory or image path list!')
-        if delay < 1:
-            sys.exit('DELAY must be greater than 0.')
         if switch not in ('next', 'random'):
             sys.exit('Error: SWITCH must be either "random" or "next"')
 
         # setup images for directory-based slideshow
         if not Path(self._state['directory']).name.endswith('txt'):
             slides_setup()
-        # required for 'next' switch
-        self.images.selectedImage = self.images.sourceImages[0]
-        self.images.index_background()
+        # watch the directory so that new images join the running slideshow
+        source = getattr(self.images, 'imageDirectory', None)
+        if not self.get_state('list') and source and Path(source).is_dir():
+            watcher = Watcher([source],
+                              lambda path: self.slidesChanged.set()).start()
+        else:
+            watcher = None
+        self.build_slides(switch)
+        slides = self.iterate_slides(switch)
 
+        # the next slide is selected, validated and rendered by this thread
+        # while the current one is shown
+        from concurrent.futures import ThreadPoolExecutor
+        prefetch = ThreadPoolExecutor(max_workers=1)
         try:
-            # count=0 sets count to number of files in imagesList
-            # starts slideshow from first images in list
+            # count=0 sets count to number of images in the slideshow
             if count <= 0:
                 print('COUNT set to number of images in directory')
-                self.images.get_imagesList()
-                count = len(self.images.imagesList)
-                self.set_state('pic', self.images.select_image('first'))
-                self.env.set_background()
-                self.images.index_background()
+                count = len(self.slides)
+            upcoming = prefetch.submit(self.prepare_slide, slides)
+            schedule.start()
             while count > 0:
-                self.set_state('pic', self.images.select_image(switch))
-                self.env.set_background()
-                time.sleep(delay)
+                self.apply_slide(upcoming.result())
+                if count > 1:
+                    upcoming = prefetch.submit(self.prepare_slide, slides)
+                # one sleep per change, to an absolute deadline
+                schedule.wait()
                 count -= 1
                 self.clear_screen()
 
@@ -74,9 +94,9 @@ class SlideShow(State):
                     # current_dir not working with ImageSelector
                     current_dir = self.bgConfig.get(
                         'Temp', 'Current Directory')
-                    time_remaining = round(float((count * delay) / 60), 2)
-                    print('{0} wallpaper changes remain over {1} minutes:\n{2}\
-                        '.format(count, time_remaining, current_dir),
+                    print('{0} wallpaper changes remain {1}:\n{2}\
+                        '.format(count, schedule.remaining(count),
+                                 current_dir),
                           '\nPress Ctrl-C to cancel.')
                 else:
                     print('rwal Slideshow\nPress Ctrl-C to cancel.')
@@ -86,9 +106,112 @@ class SlideShow(State):
         except KeyboardInterrupt:
             self.clear_screen('reset')
             sys.exit('Slideshow terminated by user...')
+        finally:
+            prefetch.shutdown()
+            if watcher is not None:
+                watcher.stop()
 
-    def clear_screen(self, com='clear'):
-        if 'APPDATA' not in os.environ:
-            subprocess.run(com, shell=True)
+    def build_slides(self, switch):
+        """order the collected images once: a shuffled permutation for
+        random, or an alphabetical list for next"""
+        if switch == 'random':
+            slides = list(self.images.sourceImages)
+            random.shuffle(slides)
         else:
+            slides = sorted(set(self.images.sourceImages))
+        self.slides = slides
+        return slides
+
+    def get_slides_refresh(self):
+        self.read_config()
+        try:
+            return self.config.getint('Defaults', 'Slideshow Refresh',
+                                      fallback=0)
+        except ValueError:
+            print('Invalid value. Check Slideshow Refresh setting.')
+            return 0
+
+    def refresh_slides(self, switch, current):
+        """collect images again, resuming after the current slide"""
+        self.images.sourceImages = []
+        self.images.get_source_images()
+        slides = self.build_slides(switch)
+        if switch == 'random' or current is None:
+            return 0
+        return bisect.bisect_right(slides, current)
+
+    def iterate_slides(self, switch):
+        """yield slides from memory without end; the image source is only
+        collected again when the refresh interval from rwal.conf passes or
+        the watcher reports a change"""
+        refresh = self.get_slides_refresh()
+        refreshed = time.monotonic()
+        position, current = 0, None
+        mode = self.get_selection_mode() if switch == 'random' else None
+        while True:
+            if self.slidesChanged.is_set() or \
+                    (refresh > 0 and time.monotonic() - refreshed >= refresh):
+                self.slidesChanged.clear()
+                refreshed = time.monotonic()
+                position = self.refresh_slides(switch, current)
+            if mode == 'weighted':
+                yield ShowHistory().choose(self.slides)
+                continue
+            elif mode == 'shuffle':
+                yield ShuffleBag().choose(self.slides,
+                                          self.images.get_source_key())
+                continue
+            if position >= len(self.slides):
+                if switch == 'random':
+                    random.shuffle(self.slides)
+                else:
+                    print('Reached end of list: applying first image in list!')
+                position = 0
+            current = self.slides[position]
+            position += 1
+            yield current
+
+    @instrument.timed('prepare slide')
+    def prepare_slide(self, slides):
+        """select the next valid slide, moving past corrupted or missing
+        files, and render it if the render cache is on; runs in the prefetch
+        thread"""
+        for attempt in range(max(1, len(self.slides))):
+            slide = next(slides)
+            try:
+                if self.images.get_image_type(slide) in self.fileTypes:
+                    break
+            except OSError:
+                pass
+            print('rwal skipped:\n{}\nIt is a corrupted or missing file.\
+                '.format(slide))
+        else:
+            sys.exit('No valid images found for the slideshow.')
+        render = RenderCache()
+        if render.is_enabled():
+            # set_background() then finds the rendered copy in the cache
+            render.render(slide, self.env.get_render_mode())
+        return slide
+
+    @instrument.timed('apply slide')
+    def apply_slide(self, slide):
+        """apply a prepared slide"""
+        self.images.selectedImage = slide
+        self.set_state('pic', slide)
+        self.env.set_background()
+        # keep next/previous and -b in step with the slideshow
+        self.images.index_background()
+        self.images.record_background()
+        self.flush_bgConfig()
+
+    def clear_screen(self, com='clear'):
+        """clear the terminal with escape codes rather than a clear process;
+        output to a pipe or file is left uncleared"""
+        if 'APPDATA' in os.environ:
+            instrument.count('subprocess')
             subprocess.run('cls', shell=True)
+        elif sys.stdout.isatty():
+            # reset also restores terminal state; clear erases scrollback
+            sys.stdout.write('\033c' if com == 'reset'
+                             else '\033[H\033[2J\033[3J')
+            sys.stdout.flush()
@@ -2,21 +2,34 @@
 """
 A singleton inherited by the other classes in rwal
 """
-import os, configparser
+import os, atexit, threading, contextlib, configparser
+from importlib.util import find_spec
 from pathlib import Path
 from textwrap import dedent
+import instrument
 
 
 class State:
     """distribute dictionary and getter/setter to child objects"""
-    _state = dict(
+    # per-invocation options, restored before each daemon request
+    _options = dict(
         home=os.path.expanduser('~'),
         verbose=False,
         directory=None,
         filter=False,
+        monitor=None,
+        per_monitor=False,
+        tolerance=None,
+        min_width=0,
+        min_height=0,
         slideshow=False,
         list=False,
         pwd=False,
+        jobs=None,
+        selection=None,
+        rescan=False,
+        render_cache=False,
+        dedupe=False,
         image_action='random',
         mode=False,
         mode_error=dedent("""\
@@ -24,29 +37,32 @@ class State:
             check modes in rwal.conf
             fallback mode applied""")
     )
+    _state = dict(_options, daemon=False)
+    # guards the shared background.conf parser and its buffered changes
+    _bgLock = threading.RLock()
+    _bgFlushRegistered = False
 
     def __init__(self):
         self.__dict__ = self._state
+        # shared attributes are set up by the first instance in a process
+        if self._state.get('initialized'):
+            return
+        self.initialized = True
 
         # absence of packages reduces functionality but won't break script, so proceed
         self.depends = dict(xclip=['/usr/bin/xclip', True],
                             feh=['/usr/bin/feh', True])
-        self.modules = dict(Pillow=None, Tkinter=None)
 
-        # python module dependencies
-        try:
-            from PIL import Image
-            self.modules['Pillow'] = True
-        except ImportError:
-            self.modules['Pillow'] = False
-        try:
-            import tkinter as tk
-            self.modules['Tkinter'] = True
-        except ImportError:
-            self.modules['Tkinter'] = False
+        # python module dependencies, located without importing them; code
+        # paths that need them import them when used
+        self.modules = dict(Pillow=find_spec('PIL') is not None,
+                            Tkinter=find_spec('tkinter') is not None,
+                            NumPy=find_spec('numpy') is not None)
 
-        # valid image types; to expand, use imghdr.what() values
+        # valid image types; to expand, use headers.probe_image() type values
         self.fileTypes = ('jpeg', 'png', 'bmp')
+        # filename extensions collected from image directories
+        self.extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')
 
         # directory flags, used for argument test in start_slideshow()
         self.dirFlags = ('directory1', 'directory2', 'directory3', 'directory4',
@@ -71,8 +87,16 @@ class State:
                            'background.conf')
         # configuration file parser
         self.config = configparser.RawConfigParser(allow_no_value=True)
-        # background config parser
-        self.bgConfig = configparser.RawConfigParser(allow_no_value=True)
+        self.configLoaded = False
+        # background config parser, loaded once and shared with its buffered
+        # changes by every instance; see flush_bgConfig()
+        if 'bgConfig' not in self._state:
+            self.bgConfig = self.new_bgConfig()
+            self.bgLoaded = False
+            self.bgChanges = {}
+
+    def reset_state(self):
+        self._state.update(self._options)
 
     def set_state(self, key, value):
         self._state[key] = value
@@ -81,14 +105,126 @@ class State:
         return self._state.get(key, None)
 
     def read_config(self):
-        return self.config.read(str(self.configFile))
+        """parse rwal.conf on first use only"""
+        if not self.configLoaded:
+            instrument.count('config_read')
+            self.config.read(str(self.configFile))
+            self.configLoaded = True
+        return self.config
 
     def get_config(self, section, subsection):
         self.read_config()
         return self.config.get(section, subsection)
 
+    def get_jobs(self):
+        """worker threads for scanning and probing; commandline overrides
+        rwal.conf"""
+        if self._state['jobs']:
+            return max(1, self._state['jobs'])
+        self.read_config()
+        try:
+            jobs = self.config.getint('Defaults', 'Jobs', fallback=4)
+        except ValueError:
+            print('Invalid value. Check Jobs setting.')
+            jobs = 4
+        return max(1, jobs)
+
+    def get_selection_mode(self):
+        """how random images are picked; commandline overrides rwal.conf"""
+        if self._state['selection']:
+            return self._state['selection']
+        self.read_config()
+        mode = self.config.get('Defaults', 'Selection Mode', fallback='random')
+        if mode not in ('random', 'weighted', 'shuffle'):
+            print('Invalid value. Check Selection Mode setting.')
+            return 'random'
+        return mode
+
+    def worker_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.get_jobs())
+
+    @staticmethod
+    def new_bgConfig():
+        # strict=False loads files left with duplicate options by older
+        # versions; the next flush writes them back clean
+        return configparser.RawConfigParser(allow_no_value=True, strict=False)
+
     def read_bgConfig(self):
-        return self.bgConfig.read(str(self.bgFile))
+        """parse background.conf on first use only; later reads, and any
+        buffered changes, are served from memory"""
+        with self._bgLock:
+            if not self.bgLoaded:
+                self.bgConfig = self.new_bgConfig()
+                instrument.count('config_read')
+                self.bgConfig.read(str(self.bgFile))
+                for (section, option), value in self.bgChanges.items():
+                    self.apply_bgChange(self.bgConfig, section, option, value)
+                self.bgLoaded = True
+        return self.bgConfig
+
+    @staticmethod
+    def apply_bgChange(parser, section, option, value):
+        if not parser.has_section(section):
+            parser.add_section(section)
+        parser.set(section, option, value)
+
+    def set_bgConfig(self, option, value, section='Temp'):
+        """buffer a background.conf change until flush_bgConfig()"""
+        with self._bgLock:
+            self.read_bgConfig()
+            self.apply_bgChange(self.bgConfig, section, option, value)
+            self.bgChanges[(section, option)] = value
+            if not State._bgFlushRegistered:
+                atexit.register(self.flush_bgConfig)
+                State._bgFlushRegistered = True
+
+    @contextlib.contextmanager
+    def lock_bgFile(self):
+        """exclusive lock serializing background.conf writers across
+        processes, such as hotkeys pressed during a slideshow"""
+        try:
+            import fcntl
+        except ImportError:  # Windows: only in-process locking
+            yield
+            return
+        with open(str(self.bgFile) + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            yield
+
+    def flush_bgConfig(self):
+        """write buffered changes once, merged into the file's current
+        contents, then atomically replace background.conf"""
+        with self._bgLock:
+            if not self.bgChanges:
+                return
+            import tempfile
+            os.makedirs(self.configDirectory, exist_ok=True)
+            with self.lock_bgFile():
+                current = self.new_bgConfig()
+                instrument.count('config_read')
+                instrument.count('config_write')
+                current.read(str(self.bgFile))
+                for (section, option), value in self.bgChanges.items():
+                    self.apply_bgChange(current, section, option, value)
+                descriptor, staging = tempfile.mkstemp(
+                    dir=self.configDirectory, prefix='.background.',
+                    suffix='.tmp')
+                try:
+                    with os.fdopen(descriptor, 'w') as configfile:
+                        current.write(configfile)
+                    os.replace(staging, str(self.bgFile))
+                except BaseException:
+                    os.remove(staging)
+                    raise
+            self.bgConfig = current
+            self.bgChanges.clear()
+
+    def reload_bgConfig(self):
+        """flush, then re-read background.conf on next use; used between
+        daemon requests, since other processes may have changed it"""
+        self.flush_bgConfig()
+        self.bgLoaded = False
 
     def get_bgConfig(self, temp='Temp', background='Current Background'):
         self.read_bgConfig()
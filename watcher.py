@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Module for watching image directories, so that a long-running rwal picks up
+added, removed and moved images without rescanning the library"""
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+from state import State
+from index import ImageIndex
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+             IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII')
+
+
+class WatchLimitError(OSError):
+    """raised when inotify watches or instances are exhausted"""
+
+
+def guarded(on_change):
+    """on_change, reporting rather than raising its errors, so that one bad
+    callback can't end the watch"""
+    def notify(path):
+        try:
+            on_change(path)
+        except Exception as error:
+            print('rwal watcher: {!r} while handling {}'.format(error, path),
+                  file=sys.stderr)
+    return notify
+
+
+class Watcher(State):
+    """apply filesystem changes under the given roots to the library index,
+    calling on_change with each changed path"""
+
+    def __init__(self, roots, on_change=None):
+        super(Watcher, self).__init__()
+        self.watchRoots = sorted({os.path.abspath(root) for root in roots})
+        self.onChange = guarded(on_change or (lambda path: None))
+        self.watchThread = None
+        self.inotify = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """watch with inotify where possible, polling directory mtimes when
+        inotify is unavailable or its limits are exhausted"""
+        inotify = None
+        try:
+            inotify = InotifyWatcher(self.watchRoots, self.onChange)
+            inotify.add_roots()
+        except (OSError, AttributeError) as error:  # limits, or not Linux
+            if self._state['verbose']:
+                print('NOTICE: inotify unavailable ({}), polling image '
+                      'directories instead.'.format(error))
+            if inotify is not None:
+                inotify.close()
+            inotify = None
+        index = ImageIndex()
+        for root in self.watchRoots:
+            index.refresh(root)
+        self.inotify = inotify
+        self.watchThread = threading.Thread(
+            target=self.watch, args=(inotify.run if inotify is not None
+                                     else self.poll,), daemon=True)
+        index.watchedRoots.update(self.watchRoots)
+        self.watchThread.start()
+        return self
+
+    def watch(self, target):
+        """run the watch loop; should it end before stop(), requests go back
+        to refreshing these trees by directory mtime"""
+        try:
+            target()
+        finally:
+            if not self.stopped.is_set():
+                ImageIndex().watchedRoots.difference_update(self.watchRoots)
+
+    def stop(self):
+        ImageIndex().watchedRoots.difference_update(self.watchRoots)
+        self.stopped.set()
+        if self.inotify is not None:
+            self.inotify.stop()
+        if self.watchThread is not None:
+            self.watchThread.join()
+
+    def get_poll_interval(self):
+        self.read_config()
+        try:
+            return max(1, self.config.getint('Defaults', 'Poll Interval',
+                                             fallback=60))
+        except ValueError:
+            print('Invalid value. Check Poll Interval setting.')
+            return 60
+
+    def poll(self):
+        """refresh the index periodically; only changed directories are
+        rescanned"""
+        index = ImageIndex()
+        interval = self.get_poll_interval()
+        while not self.stopped.wait(interval):
+            for root in self.watchRoots:
+                for directory in index.refresh(root):
+                    self.onChange(directory)
+
+
+class InotifyWatcher:
+    """recursive inotify watch over a set of directory trees, via ctypes"""
+
+    def __init__(self, roots, on_change):
+        self.roots = roots
+        self.onChange = on_change
+        self.watches = {}
+        self.index = ImageIndex()
+        import ctypes.util
+        self.get_errno = ctypes.get_errno
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchLimitError(self.get_errno(), 'inotify_init1 failed')
+        # written to by stop() to wake the blocked reader
+        self.stopRead, self.stopWrite = os.pipe()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self.stopRead)
+            os.close(self.stopWrite)
+            self.fd = -1
+
+    def stop(self):
+        if self.fd >= 0:
+            os.write(self.stopWrite, b'\0')
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                         WATCH_MASK)
+        if wd < 0:
+            code = self.get_errno()
+            if code in (errno.ENOSPC, errno.EMFILE):
+                raise WatchLimitError(code, os.strerror(code))
+            return  # directory vanished or is unreadable
+        self.watches[wd] = directory
+
+    def add_tree(self, directory):
+        self.add_watch(directory)
+        # os.walk() lists symlinked directories without entering them; the
+        # index leaves them out, so they aren't watched either
+        for root, dirnames, filenames in os.walk(directory):
+            for name in dirnames:
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    self.add_watch(path)
+
+    def remove_tree(self, directory):
+        """stop watching a directory moved out from under a root"""
+        prefix = directory.rstrip(os.sep) + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def add_roots(self):
+        for root in self.roots:
+            self.add_tree(root)
+
+    def read_events(self):
+        """block until events arrive, then yield (mask, path) pairs"""
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                yield mask, None
+            elif directory is not None:
+                yield mask, os.path.join(directory, os.fsdecode(name))
+
+    def apply(self, mask, path):
+        """reflect one event in the index"""
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+                self.index.refresh(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_tree(path)
+                self.index.rebuild(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            if path.endswith(self.index.extensions):
+                self.index.add_file(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.index.remove_file(path)
+        else:  # creation is reported on close, once the file is complete
+            return
+        self.onChange(path)
+
+    def run(self):
+        while self.fd >= 0:
+            readable = select.select([self.fd, self.stopRead], [], [])[0]
+            if self.stopRead in readable:
+                return self.close()
+            try:
+                for mask, path in self.read_events():
+                    if path is None:  # kernel queue overflowed
+                        for root in self.roots:
+                            for directory in self.index.refresh(root):
+                                self.onChange(directory)
+                    else:
+                        self.apply(mask, path)
+            except WatchLimitError as error:
+                # new directories can't be watched; requests go back to
+                # refreshing these trees by directory mtime
+                print('rwal watcher: {}; falling back to mtime checks.'
+                      .format(error), file=sys.stderr)
+                self.index.watchedRoots.difference_update(self.roots)
+                self.close()
+            except OSError:
+                return